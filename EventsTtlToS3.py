@@ -0,0 +1,71 @@
+import gzip
+import json
+import boto3
+
+from archivePartitioning import partition_prefix
+from dynamoTypes import to_item
+
+# Consumes the ColorControllerEvents stream (NEW_AND_OLD_IMAGES or OLD_IMAGE)
+# and archives items removed by TTL, so expired hot data stays queryable in S3
+# under color_controller_events/event_type=<type>/year=.../hour=.../
+# Those hours closed long before their items expire, so they carry no
+# manifest; readers LIST them.
+
+s3 = boto3.client('s3')
+BUCKET_NAME = 'pill-dispenser-analytics-us-east-2-7375388'
+ARCHIVE_PREFIX = 'color_controller_events'
+
+
+def json_default(obj):
+    # String/number sets come back as Python sets; archive them as sorted lists
+    if isinstance(obj, set):
+        return sorted(obj, key=str)
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def is_ttl_removal(record):
+    # TTL deletions are REMOVE events performed by the DynamoDB service itself
+    identity = record.get('userIdentity') or {}
+    return (record.get('eventName') == 'REMOVE'
+            and identity.get('type') == 'Service'
+            and identity.get('principalId') == 'dynamodb.amazonaws.com')
+
+
+def lambda_handler(event, context):
+    groups = {}
+    first_event_id = {}
+    for record in event.get('Records', []):
+        if not is_ttl_removal(record):
+            continue
+        image = record['dynamodb'].get('OldImage')
+        if not image:
+            continue
+        item = to_item(image)
+        timestamp_ms = int(item.get('timestamp', 0)) * 1000
+        item['event_timestamp'] = timestamp_ms
+        event_type = item.get('event_type', 'unknown')
+
+        leaf = partition_prefix(f"{ARCHIVE_PREFIX}/event_type={event_type}", timestamp_ms, item.get('thing_name'))
+        groups.setdefault(leaf, []).append(item)
+        first_event_id.setdefault(leaf, record['eventID'])
+
+    # One object per partition per batch; keyed by the batch's first eventID so
+    # a retried batch overwrites instead of duplicating.
+    written = 0
+    try:
+        for leaf, items in groups.items():
+            s3_key = f"{leaf}expired-{first_event_id[leaf]}.jsonl.gz"
+            body = gzip.compress(''.join(json.dumps(i, separators=(',', ':'), default=json_default) + '\n' for i in items).encode('utf-8'))
+            s3.put_object(
+                Bucket=BUCKET_NAME,
+                Key=s3_key,
+                Body=body,
+                ContentType='application/gzip'
+            )
+            written += len(items)
+        print(f"Archived {written} expired items into {len(groups)} partitions")
+        return {'statusCode': 200, 'archived': written}
+    except Exception as e:
+        # Raise so the stream retries the batch; nothing is lost while it does
+        print(f"Error: {str(e)}")
+        raise e
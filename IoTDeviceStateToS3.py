@@ -1,6 +1,8 @@
 import json
 import boto3
-from datetime import datetime
+from datetime import datetime, timezone
+
+from archivePartitioning import object_key
 
 s3 = boto3.client('s3')
 BUCKET_NAME = 'pill-dispenser-analytics-us-east-2-7375388'
@@ -10,8 +12,8 @@ def lambda_handler(event, context):
     timestamp_ms = event.get('event_timestamp', int(datetime.now().timestamp() * 1000))
     reported_state = event.get('reported_state', {})
     
-    # Convert timestamp to date parts
-    dt = datetime.fromtimestamp(timestamp_ms / 1000)
+    # Convert timestamp to UTC date parts (same as the S3 partition)
+    dt = datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc)
     year, month, day = dt.year, dt.month, dt.day
     
     # Prepare data for device_state table (with map structure)
@@ -25,7 +27,7 @@ def lambda_handler(event, context):
     }
     
     # Build S3 key
-    s3_key = f"device_state/year={year}/month={month}/day={day}/{timestamp_ms}.json"
+    s3_key = object_key("device_state", timestamp_ms, thing_name)
     
     # Write to S3
     try:
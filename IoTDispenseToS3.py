@@ -2,6 +2,8 @@ import json
 import boto3
 from datetime import datetime
 
+from archivePartitioning import object_key
+
 s3 = boto3.client('s3')
 BUCKET_NAME = 'pill-dispenser-analytics-us-east-2-7375388'
 
@@ -10,14 +12,8 @@ def lambda_handler(event, context):
     thing_name = event.get('thing_name', 'unknown')
     timestamp_ms = event.get('event_timestamp', int(datetime.now().timestamp() * 1000))
     
-    # Convert timestamp to datetime
-    dt = datetime.fromtimestamp(timestamp_ms / 1000)
-    year = dt.year
-    month = dt.month
-    day = dt.day
-    
-    # Build S3 key with proper partitions
-    s3_key = f"dispense_completed/year={year}/month={month}/day={day}/{timestamp_ms}.json"
+    # Build S3 key with canonical UTC partitions
+    s3_key = object_key("dispense_completed", timestamp_ms, thing_name)
     
     # Write to S3
     try:
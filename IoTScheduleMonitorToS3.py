@@ -1,6 +1,8 @@
 import json
 import boto3
-from datetime import datetime
+from datetime import datetime, timezone
+
+from archivePartitioning import object_key
 
 s3 = boto3.client('s3')
 BUCKET_NAME = 'pill-dispenser-analytics-us-east-2-7375388'
@@ -9,8 +11,8 @@ def lambda_handler(event, context):
     thing_name = event.get('thing_name', 'unknown')
     timestamp_ms = event.get('event_timestamp', int(datetime.now().timestamp() * 1000))
     
-    # Convert timestamp to date parts
-    dt = datetime.fromtimestamp(timestamp_ms / 1000)
+    # Convert timestamp to UTC date parts (same as the S3 partition)
+    dt = datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc)
     year, month, day = dt.year, dt.month, dt.day
     
     # Prepare data for schedule_monitor table
@@ -34,7 +36,7 @@ def lambda_handler(event, context):
     }
     
     # Build S3 key
-    s3_key = f"schedule_monitor/year={year}/month={month}/day={day}/{timestamp_ms}.json"
+    s3_key = object_key("schedule_monitor", timestamp_ms, thing_name)
     
     # Write to S3
     try:
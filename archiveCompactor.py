@@ -0,0 +1,368 @@
+"""
+Small-file compaction for the analytics bucket.
+
+Merges the one-object-per-event `.json` files of a partition into a few
+gzipped JSON-lines parts (`part-<run>-<n>.jsonl.gz`), verifies that every
+source record made it into a part, swaps the partition manifest over to the
+parts in one conditional write, and only then deletes the originals.
+
+Safe alongside live writers:
+  * Only objects from the LIST snapshot taken at the start, and older than
+    `--min-age-minutes`, are merged; anything arriving later is untouched.
+  * The manifest swap is a conditional read-modify-write, so entries that
+    writers append mid-run are preserved.
+  * A `_compaction.lock` lease (If-None-Match create) keeps two compactors
+    off the same partition.
+
+Sealing: live writers do not maintain manifests. A partition whose hour (or
+legacy day) ended more than `--seal-grace-minutes` ago is sealed under the
+lease, after the merge or instead of it when there is nothing to merge:
+its manifest is rebuilt from LIST and marked complete, and manifest readers
+use it from then on. Run the compactor on a schedule (e.g. hourly over
+yesterday and today) so every hour is sealed shortly after its grace period.
+
+Readers that go through the manifest see either the originals or the parts,
+never both. Readers that LIST the prefix (plain Athena tables) can see both
+for the few seconds between the part upload and the delete.
+
+Usage:
+    python archiveCompactor.py --start 2024-01-01 --end 2025-11-30 \\
+        --partition-workers 8 --min-age-minutes 60
+"""
+import argparse
+import gzip
+import json
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import boto3
+from botocore.exceptions import ClientError
+
+from archiveManifest import (
+    CONFLICT_ERROR_CODES,
+    is_data_key,
+    iter_object_records,
+    make_entry,
+    rebuild_manifest,
+    record_timestamp,
+    update_manifest,
+)
+from archivePartitioning import discover_leaf_prefixes, legacy_day_prefixes, partition_end
+from archiveReplay import iter_days, parse_day
+
+# ---------- CONFIG ----------
+S3_BUCKET = "pill-dispenser-analytics-us-east-2-7375388"
+S3_REGION = "us-east-2"
+
+ARCHIVE_PREFIXES = ("dispense_completed", "device_state", "schedule_monitor")
+
+LOCK_NAME = "_compaction.lock"
+LOCK_TTL_SEC = 3600
+
+# Uncompressed bytes per part; keeps each part well inside a single Athena split.
+DEFAULT_PART_BYTES = 64 * 1024 * 1024
+DEFAULT_MIN_OBJECTS = 2
+DEFAULT_MIN_AGE_MINUTES = 60
+# Late arrivals (retried IoT rule actions, parked proxy events) land within this
+DEFAULT_SEAL_GRACE_MINUTES = 60
+DEFAULT_PARTITION_WORKERS = 4
+DEFAULT_GET_WORKERS = 8
+# Keys handed to a partition's GET pool at once; bounds memory per partition.
+FETCH_CHUNK = 128
+DELETE_BATCH = 1000
+
+s3_client = boto3.client("s3", region_name=S3_REGION)
+
+
+# ---------- LOCKING ----------
+def acquire_lock(partition_prefix: str, run_id: str) -> bool:
+    """Create the partition lease; take over an expired one."""
+    key = f"{partition_prefix}{LOCK_NAME}"
+    body = json.dumps({"run_id": run_id, "expires_at": int(time.time()) + LOCK_TTL_SEC})
+    try:
+        s3_client.put_object(Bucket=S3_BUCKET, Key=key, Body=body, IfNoneMatch="*")
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") not in CONFLICT_ERROR_CODES:
+            raise
+
+    resp = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+    held = json.loads(resp["Body"].read())
+    if held.get("expires_at", 0) > time.time():
+        return False
+    try:
+        s3_client.put_object(Bucket=S3_BUCKET, Key=key, Body=body, IfMatch=resp["ETag"])
+        return True
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in CONFLICT_ERROR_CODES:
+            return False
+        raise
+
+
+def release_lock(partition_prefix: str) -> None:
+    s3_client.delete_object(Bucket=S3_BUCKET, Key=f"{partition_prefix}{LOCK_NAME}")
+
+
+# ---------- SNAPSHOT ----------
+def snapshot(partition_prefix: str, min_age_minutes: int) -> Tuple[List[str], List[str]]:
+    """
+    Return (sources, others): small `.json` objects old enough to merge, and
+    every other data key currently in the partition.
+    """
+    cutoff = time.time() - min_age_minutes * 60
+    sources, others = [], []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=partition_prefix, Delimiter="/"):
+        for obj in page.get("Contents", []):
+            key = obj["Key"]
+            if not is_data_key(key):
+                continue
+            if key.endswith(".json") and obj["LastModified"].timestamp() < cutoff:
+                sources.append(key)
+            else:
+                others.append(key)
+    return sources, others
+
+
+# ---------- PART WRITER ----------
+class PartWriter:
+    """Streams JSON lines into a gzipped temp file and tracks manifest stats."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.file = tempfile.TemporaryFile()
+        self.gz = gzip.GzipFile(fileobj=self.file, mode="wb")
+        self.raw_bytes = 0
+        self.records = 0
+        self.min_ts = None
+        self.max_ts = None
+        self.thing_names = set()
+
+    def write(self, record: Dict[str, Any]) -> None:
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        self.gz.write(line)
+        self.raw_bytes += len(line)
+        self.records += 1
+        ts = record_timestamp(record)
+        if ts is not None:
+            self.min_ts = ts if self.min_ts is None else min(self.min_ts, ts)
+            self.max_ts = ts if self.max_ts is None else max(self.max_ts, ts)
+        self.thing_names.add(record.get("thing_name"))
+
+    def upload(self) -> Dict[str, Any]:
+        self.gz.close()
+        self.file.seek(0)
+        s3_client.upload_fileobj(
+            self.file, S3_BUCKET, self.key,
+            ExtraArgs={"ContentType": "application/gzip"},
+        )
+        self.file.close()
+        return make_entry(self.key, self.records, self.min_ts, self.max_ts, self.thing_names)
+
+    def discard(self) -> None:
+        self.gz.close()
+        self.file.close()
+
+
+def count_part_records(key: str) -> int:
+    return sum(1 for _ in iter_object_records(s3_client, S3_BUCKET, key))
+
+
+# ---------- COMPACTION ----------
+def is_sealable(partition_prefix: str, grace_minutes: int) -> bool:
+    """True once the partition's hour (or legacy day) plus the grace period is over."""
+    end = partition_end(partition_prefix)
+    return end is not None and end + timedelta(minutes=grace_minutes) <= datetime.now(timezone.utc)
+
+
+def chunked(keys: List[str], size: int) -> Iterator[List[str]]:
+    for i in range(0, len(keys), size):
+        yield keys[i:i + size]
+
+
+def delete_keys(keys: List[str]) -> None:
+    for batch in chunked(keys, DELETE_BATCH):
+        s3_client.delete_objects(
+            Bucket=S3_BUCKET,
+            Delete={"Objects": [{"Key": k} for k in batch], "Quiet": True},
+        )
+
+
+def compact_partition(partition_prefix: str,
+                      run_id: str,
+                      part_bytes: int = DEFAULT_PART_BYTES,
+                      min_objects: int = DEFAULT_MIN_OBJECTS,
+                      min_age_minutes: int = DEFAULT_MIN_AGE_MINUTES,
+                      get_workers: int = DEFAULT_GET_WORKERS,
+                      seal_grace_minutes: int = DEFAULT_SEAL_GRACE_MINUTES,
+                      dry_run: bool = False) -> Dict[str, Any]:
+    result = {"partition": partition_prefix, "sources": 0, "records": 0, "parts": 0, "status": "skipped"}
+    sealable = is_sealable(partition_prefix, seal_grace_minutes)
+
+    if dry_run:
+        sources, _ = snapshot(partition_prefix, min_age_minutes)
+        result.update(sources=len(sources), status="dry_run" if len(sources) >= min_objects else "skipped")
+        return result
+    if not acquire_lock(partition_prefix, run_id):
+        result["status"] = "locked"
+        return result
+
+    parts: List[PartWriter] = []
+    uploaded: List[Dict[str, Any]] = []
+    swapped = False
+    try:
+        # Snapshot under the lease so a previous run's deletes are visible.
+        sources, others = snapshot(partition_prefix, min_age_minutes)
+        result["sources"] = len(sources)
+        if len(sources) < min_objects:
+            if sealable:
+                rebuild_manifest(s3_client, S3_BUCKET, partition_prefix)
+                result["status"] = "sealed"
+            return result
+
+        # 1. Stream every source record into size-bounded gzip parts.
+        part = None
+        expected = 0
+
+        def read(key: str) -> Optional[List[Dict[str, Any]]]:
+            try:
+                return list(iter_object_records(s3_client, S3_BUCKET, key))
+            except Exception as e:
+                print(f"[compact_partition] cannot read {key}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, get_workers)) as pool:
+            for keys in chunked(sources, FETCH_CHUNK):
+                for key, records in zip(keys, pool.map(read, keys)):
+                    if records is None:
+                        raise RuntimeError(f"unreadable source {key}")
+                    for record in records:
+                        if part is None or part.raw_bytes >= part_bytes:
+                            part = PartWriter(f"{partition_prefix}part-{run_id}-{len(parts):04d}.jsonl.gz")
+                            parts.append(part)
+                        part.write(record)
+                        expected += 1
+
+        # 2. Upload and verify record counts against what was read.
+        for part in parts:
+            uploaded.append(part.upload())
+        for entry in uploaded:
+            found = count_part_records(entry["key"])
+            if found != entry["records"]:
+                raise RuntimeError(f"{entry['key']} holds {found} records, expected {entry['records']}")
+        if sum(e["records"] for e in uploaded) != expected:
+            raise RuntimeError("part record total does not match sources")
+
+        # 3. Swap the manifest to the parts in one conditional write.
+        merged = set(sources)
+
+        def mutate(manifest):
+            kept = [o for o in manifest["objects"] if o["key"] not in merged]
+            indexed = {o["key"] for o in kept}
+            manifest["objects"] = kept + uploaded
+            # Our LIST saw the whole partition; if every object we did not
+            # merge is indexed too, the manifest is now complete.
+            if all(k in indexed for k in others):
+                manifest["complete"] = True
+            return manifest
+
+        update_manifest(s3_client, S3_BUCKET, partition_prefix, mutate)
+        swapped = True
+
+        # 4. Drop the originals.
+        delete_keys(sources)
+
+        # 5. Seal a closed partition: index what the merge left from LIST.
+        if sealable:
+            rebuild_manifest(s3_client, S3_BUCKET, partition_prefix)
+            result["sealed"] = True
+
+        result.update(records=expected, parts=len(uploaded), status="compacted")
+        return result
+
+    except Exception as e:
+        print(f"[compact_partition] {partition_prefix} aborted: {e}")
+        for part in parts[len(uploaded):]:
+            part.discard()
+        # Once the manifest points at the parts they are the live copy; a
+        # failed delete only leaves duplicates for the next run to clear.
+        if uploaded and not swapped:
+            delete_keys([entry["key"] for entry in uploaded])
+        result["status"] = "failed"
+        result["error"] = str(e)
+        return result
+    finally:
+        release_lock(partition_prefix)
+
+
+def compact(start, end,
+            prefixes: Tuple[str, ...] = ARCHIVE_PREFIXES,
+            partition_workers: int = DEFAULT_PARTITION_WORKERS,
+            **kwargs) -> List[Dict[str, Any]]:
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+    # Legacy day-level partitions plus every canonical hour/bucket leaf below them.
+    day_prefixes = dict.fromkeys(
+        prefix
+        for day in iter_days(start, end)
+        for event_prefix in prefixes
+        for prefix in legacy_day_prefixes(event_prefix, day)
+    )
+    partitions = [
+        leaf
+        for prefix in day_prefixes
+        for leaf in discover_leaf_prefixes(s3_client, S3_BUCKET, prefix)
+    ]
+
+    def run(prefix: str) -> Dict[str, Any]:
+        result = compact_partition(prefix, run_id, **kwargs)
+        print("[compact]", json.dumps(result))
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, partition_workers)) as pool:
+        return list(pool.map(run, partitions))
+
+
+# ---------- CLI ----------
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Compact small archive objects into gzipped JSON-lines parts.")
+    ap.add_argument("--start", required=True, type=parse_day)
+    ap.add_argument("--end", required=True, type=parse_day)
+    ap.add_argument("--prefixes", default=",".join(ARCHIVE_PREFIXES))
+    ap.add_argument("--partition-workers", type=int, default=DEFAULT_PARTITION_WORKERS)
+    ap.add_argument("--get-workers", type=int, default=DEFAULT_GET_WORKERS, help="parallel GETs per partition")
+    ap.add_argument("--part-mb", type=int, default=DEFAULT_PART_BYTES // (1024 * 1024))
+    ap.add_argument("--min-objects", type=int, default=DEFAULT_MIN_OBJECTS)
+    ap.add_argument("--min-age-minutes", type=int, default=DEFAULT_MIN_AGE_MINUTES)
+    ap.add_argument("--seal-grace-minutes", type=int, default=DEFAULT_SEAL_GRACE_MINUTES,
+                    help="index partitions whose hour ended this long ago")
+    ap.add_argument("--dry-run", action="store_true")
+    args = ap.parse_args(argv)
+
+    prefixes = tuple(p.strip() for p in args.prefixes.split(",") if p.strip())
+    results = compact(
+        args.start, args.end, prefixes,
+        partition_workers=args.partition_workers,
+        part_bytes=args.part_mb * 1024 * 1024,
+        min_objects=args.min_objects,
+        min_age_minutes=args.min_age_minutes,
+        get_workers=args.get_workers,
+        seal_grace_minutes=args.seal_grace_minutes,
+        dry_run=args.dry_run,
+    )
+    failed = [r for r in results if r["status"] == "failed"]
+    print(json.dumps({
+        "partitions": len(results),
+        "compacted": sum(1 for r in results if r["status"] == "compacted"),
+        "sealed": sum(1 for r in results if r["status"] == "sealed" or r.get("sealed")),
+        "failed": len(failed),
+        "records": sum(r["records"] for r in results),
+    }))
+    return 0 if not failed else 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
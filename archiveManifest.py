@@ -0,0 +1,273 @@
+"""
+Per-partition manifests for the analytics bucket.
+
+Every archive partition (e.g. dispense_completed/year=2025/month=12/day=09/)
+carries a `_manifest.json` listing the objects written to it together with
+their record count, min/max event timestamp and thing names. Readers fetch
+one small object instead of paging through LIST results, and can prune by
+device or time before issuing any GET. The leading underscore keeps Hive
+style readers (Athena, Glue, Spark) from treating the manifest as data.
+
+Manifests are built once per sealed partition, not per event: live writers
+(the proxy and the IoT*ToS3 lambdas) only PUT their objects. Once an hour
+partition is past its end plus a late-arrival grace period, the compactor
+lists it and writes its manifest with `complete` set (`rebuild_manifest`);
+until then readers LIST. Offline tools that add objects to a partition
+(compaction parts, migration) update its manifest with a read-modify-write
+guarded by S3 conditional writes (If-Match on the ETag read, If-None-Match
+for the first entry), so they never lose each other's entries.
+
+The manifest is an index, not the source of truth: readers trust it only
+once `complete` is set (`read_trusted_manifest`). An object that lands in a
+partition after it was sealed (a device replaying buffered events) is
+missed by manifest readers until the compactor next covers that day and
+re-seals it.
+"""
+import gzip
+import io
+import json
+import random
+import time
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from botocore.exceptions import ClientError
+
+MANIFEST_NAME = "_manifest.json"
+MANIFEST_VERSION = 1
+
+MAX_ATTEMPTS = 8
+BASE_BACKOFF_SEC = 0.05
+MAX_BACKOFF_SEC = 1.0
+
+# 412: someone else changed the manifest since we read it.
+# 409: a concurrent conditional write to the same key is still in flight.
+CONFLICT_ERROR_CODES = {"PreconditionFailed", "ConditionalRequestConflict"}
+
+
+# ---------- HELPERS ----------
+def manifest_key(partition_prefix: str) -> str:
+    return f"{partition_prefix.rstrip('/')}/{MANIFEST_NAME}"
+
+
+def partition_of(key: str) -> str:
+    """Partition prefix (with trailing slash) of an archived object key."""
+    return key.rsplit("/", 1)[0] + "/"
+
+
+def is_manifest_key(key: str) -> bool:
+    return key.rsplit("/", 1)[-1] == MANIFEST_NAME
+
+
+def is_data_key(key: str) -> bool:
+    """False for manifests, locks and other bookkeeping objects Hive readers skip."""
+    return not key.rsplit("/", 1)[-1].startswith(("_", "."))
+
+
+def make_entry(key: str,
+               records: int,
+               min_ts: Optional[int],
+               max_ts: Optional[int],
+               thing_names: Iterable[str]) -> Dict[str, Any]:
+    return {
+        "key": key,
+        "records": int(records),
+        "min_ts": min_ts,
+        "max_ts": max_ts,
+        "thing_names": sorted({t for t in thing_names if t}),
+    }
+
+
+def entry_for_records(key: str, records: Iterable[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build a manifest entry in one pass over decoded records."""
+    count = 0
+    min_ts = max_ts = None
+    things = set()
+    for r in records:
+        count += 1
+        ts = record_timestamp(r)
+        if ts is not None:
+            min_ts = ts if min_ts is None else min(min_ts, ts)
+            max_ts = ts if max_ts is None else max(max_ts, ts)
+        things.add(r.get("thing_name"))
+    return make_entry(key, count, min_ts, max_ts, things)
+
+
+def record_timestamp(record: Dict[str, Any]) -> Optional[int]:
+    """Event time in epoch ms for raw events and the reshaped archive documents."""
+    ts = record.get("event_timestamp", record.get("timestamp"))
+    return int(ts) if ts is not None else None
+
+
+def empty_manifest(partition_prefix: str, complete: bool = False) -> Dict[str, Any]:
+    return {
+        "version": MANIFEST_VERSION,
+        "partition": partition_prefix,
+        "complete": complete,
+        "record_count": 0,
+        "min_ts": None,
+        "max_ts": None,
+        "thing_names": [],
+        "objects": [],
+    }
+
+
+def summarize(manifest: Dict[str, Any]) -> Dict[str, Any]:
+    """Recompute partition-level totals from the object entries."""
+    objects = manifest["objects"]
+    mins = [o["min_ts"] for o in objects if o.get("min_ts") is not None]
+    maxs = [o["max_ts"] for o in objects if o.get("max_ts") is not None]
+    things = set()
+    for o in objects:
+        things.update(o.get("thing_names", []))
+    manifest["record_count"] = sum(o.get("records", 0) for o in objects)
+    manifest["min_ts"] = min(mins) if mins else None
+    manifest["max_ts"] = max(maxs) if maxs else None
+    manifest["thing_names"] = sorted(things)
+    return manifest
+
+
+# ---------- OBJECTS ----------
+def iter_object_records(s3, bucket: str, key: str) -> Iterator[Dict[str, Any]]:
+    """
+    Yield the records of one archived object.
+
+    Writers store one JSON document per `.json` object; compacted parts are
+    gzipped JSON lines and are decoded as a stream.
+    """
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+    if key.endswith(".jsonl.gz"):
+        with gzip.GzipFile(fileobj=body) as gz:
+            for line in io.TextIOWrapper(gz, encoding="utf-8"):
+                if line.strip():
+                    yield json.loads(line)
+        return
+    doc = json.loads(body.read())
+    if isinstance(doc, list):
+        yield from doc
+    else:
+        yield doc
+
+
+# ---------- READ ----------
+def read_manifest(s3, bucket: str, partition_prefix: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """Return (manifest, etag), or (None, None) when the partition has none yet."""
+    try:
+        resp = s3.get_object(Bucket=bucket, Key=manifest_key(partition_prefix))
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ("NoSuchKey", "404"):
+            return None, None
+        raise
+    return json.loads(resp["Body"].read()), resp["ETag"]
+
+
+def read_trusted_manifest(s3, bucket: str, partition_prefix: str) -> Optional[Dict[str, Any]]:
+    """The manifest if it indexes every object in the partition, else None (LIST instead)."""
+    manifest, _ = read_manifest(s3, bucket, partition_prefix)
+    if manifest is None or not manifest.get("complete"):
+        return None
+    return manifest
+
+
+def plan_reads(manifest: Dict[str, Any],
+               thing_names: Optional[Iterable[str]] = None,
+               start_ms: Optional[int] = None,
+               end_ms: Optional[int] = None) -> List[str]:
+    """Object keys in the partition that may hold matching records."""
+    wanted = set(thing_names) if thing_names else None
+    keys = []
+    for o in manifest.get("objects", []):
+        if wanted is not None and not wanted.intersection(o.get("thing_names", [])):
+            continue
+        if start_ms is not None and o.get("max_ts") is not None and o["max_ts"] < start_ms:
+            continue
+        if end_ms is not None and o.get("min_ts") is not None and o["min_ts"] > end_ms:
+            continue
+        keys.append(o["key"])
+    return keys
+
+
+# ---------- WRITE ----------
+def update_manifest(s3,
+                    bucket: str,
+                    partition_prefix: str,
+                    mutate: Callable[[Dict[str, Any]], Dict[str, Any]],
+                    attempts: int = MAX_ATTEMPTS) -> Dict[str, Any]:
+    """
+    Apply `mutate` to the partition manifest with optimistic concurrency.
+
+    `mutate` receives the current manifest (or an empty one) and returns the
+    new one; it may be called several times if other writers interleave.
+    """
+    key = manifest_key(partition_prefix)
+    for attempt in range(attempts):
+        current, etag = read_manifest(s3, bucket, partition_prefix)
+        updated = summarize(mutate(current or empty_manifest(partition_prefix)))
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3.put_object(
+                Bucket=bucket,
+                Key=key,
+                Body=json.dumps(updated, separators=(",", ":")),
+                ContentType="application/json",
+                **condition
+            )
+            return updated
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in CONFLICT_ERROR_CODES:
+                raise
+            time.sleep(random.uniform(0, min(MAX_BACKOFF_SEC, BASE_BACKOFF_SEC * (2 ** attempt))))
+    raise RuntimeError(f"manifest update for {partition_prefix} lost {attempts} races")
+
+
+def append_entries(s3,
+                   bucket: str,
+                   partition_prefix: str,
+                   entries: List[Dict[str, Any]],
+                   attempts: int = MAX_ATTEMPTS) -> Dict[str, Any]:
+    """Add (or replace, by key) object entries in the partition manifest."""
+    new_keys = {e["key"] for e in entries}
+
+    def mutate(manifest):
+        if not manifest["objects"] and not manifest.get("complete"):
+            # First entries: the manifest is complete only if the partition
+            # held nothing else (always true for partitions of a new layout).
+            manifest["complete"] = all(
+                k in new_keys for k in list_data_keys(s3, bucket, partition_prefix)
+            )
+        manifest["objects"] = [o for o in manifest["objects"] if o["key"] not in new_keys] + entries
+        return manifest
+
+    return update_manifest(s3, bucket, partition_prefix, mutate, attempts)
+
+
+def list_data_keys(s3, bucket: str, partition_prefix: str) -> Iterator[str]:
+    """Data keys directly under `partition_prefix` (not in nested partitions)."""
+    paginator = s3.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=partition_prefix, Delimiter="/"):
+        for obj in page.get("Contents", []):
+            if is_data_key(obj["Key"]):
+                yield obj["Key"]
+
+
+def rebuild_manifest(s3, bucket: str, partition_prefix: str) -> Dict[str, Any]:
+    """
+    Regenerate a partition manifest from one LIST and mark it complete.
+    Objects already indexed keep their entries (keys are never rewritten
+    with different content); only unindexed objects are read.
+    """
+    current, _ = read_manifest(s3, bucket, partition_prefix)
+    known = {o["key"]: o for o in (current or {}).get("objects", [])}
+    entries = [
+        known.get(key) or entry_for_records(key, iter_object_records(s3, bucket, key))
+        for key in list_data_keys(s3, bucket, partition_prefix)
+    ]
+
+    def mutate(manifest):
+        # Keep entries appended by other writers after our LIST finished.
+        listed = {e["key"] for e in entries}
+        fresh = [o for o in manifest["objects"] if o["key"] not in listed and o["key"] not in known]
+        manifest["objects"] = entries + fresh
+        manifest["complete"] = True
+        return manifest
+
+    return update_manifest(s3, bucket, partition_prefix, mutate)
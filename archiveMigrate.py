@@ -0,0 +1,232 @@
+"""
+Migrate legacy archive keys to the canonical UTC layout (archivePartitioning).
+
+For each event type and day, every object sitting directly under the legacy
+day prefixes (unpadded IoT*ToS3 keys and zero-padded proxy keys) is read,
+each record is routed by its own event timestamp and thing_name to its
+canonical hour/bucket leaf, and the records are written there as gzipped
+JSON-lines parts registered in the leaf manifests. Sources are deleted only
+after every part has been re-read and its record count checked, and only
+when all of their records were routed.
+
+Records archived twice (once by the proxy, once by an IoT*ToS3 lambda) are
+collapsed on (thing_name, event timestamp) unless --keep-duplicates is set.
+The IoT*ToS3 copy is always the one kept, whatever the listing order, so
+every migrated day holds the same record shape.
+
+Usage:
+    python archiveMigrate.py --start 2024-01-01 --end 2025-12-31 --dry-run
+    python archiveMigrate.py --start 2024-01-01 --end 2025-12-31 --workers 4
+"""
+import argparse
+import json
+import re
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from archiveCompactor import (
+    ARCHIVE_PREFIXES,
+    DEFAULT_PART_BYTES,
+    FETCH_CHUNK,
+    PartWriter,
+    S3_BUCKET,
+    chunked,
+    count_part_records,
+    delete_keys,
+    s3_client,
+)
+from archiveManifest import (
+    append_entries,
+    iter_object_records,
+    list_data_keys,
+    read_manifest,
+    record_timestamp,
+    update_manifest,
+)
+from archivePartitioning import legacy_day_prefixes, partition_prefix
+from archiveReplay import iter_days, parse_day
+
+DEFAULT_WORKERS = 4
+DEFAULT_GET_WORKERS = 8
+
+_KEY_TIMESTAMP = re.compile(r"(\d{13})")
+
+
+def is_legacy_proxy_key(key: str) -> bool:
+    """The proxy named legacy objects `event_<ms>.json`; IoT*ToS3 used `<ms>.json`."""
+    return key.rsplit("/", 1)[-1].startswith("event_")
+
+
+def fallback_timestamp(key: str) -> Optional[int]:
+    """Epoch ms embedded in a legacy object name (`<ms>.json`, `event_<ms>.json`)."""
+    m = _KEY_TIMESTAMP.search(key.rsplit("/", 1)[-1])
+    return int(m.group(1)) if m else None
+
+
+def migrate_day(event_type: str,
+                day: date,
+                run_id: str,
+                dedupe: bool = True,
+                keep_source: bool = False,
+                part_bytes: int = DEFAULT_PART_BYTES,
+                get_workers: int = DEFAULT_GET_WORKERS,
+                dry_run: bool = False) -> Dict[str, Any]:
+    result = {"event_type": event_type, "day": day.isoformat(), "sources": 0,
+              "records": 0, "duplicates": 0, "unrouted": 0, "parts": 0, "status": "skipped"}
+
+    # IoT*ToS3 objects first, so deduplication keeps their copy of each record
+    sources: List[Tuple[str, str]] = sorted(
+        ((prefix, key)
+         for prefix in legacy_day_prefixes(event_type, day)
+         for key in list_data_keys(s3_client, S3_BUCKET, prefix)),
+        key=lambda source: (is_legacy_proxy_key(source[1]), source[1]),
+    )
+    result["sources"] = len(sources)
+    if not sources:
+        return result
+
+    writers: Dict[str, List[PartWriter]] = {}
+    leaf_counts: Dict[str, int] = {}
+    seen = set()
+    routed_sources: List[Tuple[str, str]] = []
+    uploaded: List[Dict[str, Any]] = []
+    indexed = False
+
+    def read(key: str) -> Optional[List[Dict[str, Any]]]:
+        try:
+            return list(iter_object_records(s3_client, S3_BUCKET, key))
+        except Exception as e:
+            print(f"[migrate_day] cannot read {key}: {e}")
+            return None
+
+    def writer_for(leaf: str) -> PartWriter:
+        parts = writers.setdefault(leaf, [])
+        if not parts or parts[-1].raw_bytes >= part_bytes:
+            parts.append(PartWriter(f"{leaf}part-migrated-{run_id}-{len(parts):04d}.jsonl.gz"))
+        return parts[-1]
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, get_workers)) as pool:
+            for batch in chunked(sources, FETCH_CHUNK):
+                for (prefix, key), records in zip(batch, pool.map(read, [k for _, k in batch])):
+                    if records is None:
+                        continue
+                    fully_routed = True
+                    for record in records:
+                        ts = record_timestamp(record) or fallback_timestamp(key)
+                        if ts is None:
+                            result["unrouted"] += 1
+                            fully_routed = False
+                            continue
+                        thing_name = record.get("thing_name")
+                        if dedupe:
+                            ident = (thing_name, ts)
+                            if ident in seen:
+                                result["duplicates"] += 1
+                                continue
+                            seen.add(ident)
+                        leaf = partition_prefix(event_type, ts, thing_name)
+                        leaf_counts[leaf] = leaf_counts.get(leaf, 0) + 1
+                        result["records"] += 1
+                        if not dry_run:
+                            writer_for(leaf).write(record)
+                    if fully_routed:
+                        routed_sources.append((prefix, key))
+
+        if dry_run:
+            result.update(status="dry_run", leaves=leaf_counts)
+            return result
+
+        # Upload, verify, then index each leaf's parts.
+        leaf_entries: Dict[str, List[Dict[str, Any]]] = {}
+        for leaf, parts in writers.items():
+            leaf_entries[leaf] = [part.upload() for part in parts]
+            uploaded.extend(leaf_entries[leaf])
+            for entry in leaf_entries[leaf]:
+                found = count_part_records(entry["key"])
+                if found != entry["records"]:
+                    raise RuntimeError(f"{entry['key']} holds {found} records, expected {entry['records']}")
+        if sum(e["records"] for e in uploaded) != result["records"]:
+            raise RuntimeError("part record total does not match routed records")
+        indexed = True
+        for leaf, entries in leaf_entries.items():
+            append_entries(s3_client, S3_BUCKET, leaf, entries)
+        result["parts"] = len(uploaded)
+
+        if not keep_source and routed_sources:
+            delete_keys([key for _, key in routed_sources])
+            for prefix in {p for p, _ in routed_sources}:
+                if read_manifest(s3_client, S3_BUCKET, prefix)[0] is None:
+                    continue
+                gone = {key for p, key in routed_sources if p == prefix}
+
+                def mutate(manifest, gone=gone):
+                    manifest["objects"] = [o for o in manifest["objects"] if o["key"] not in gone]
+                    return manifest
+
+                update_manifest(s3_client, S3_BUCKET, prefix, mutate)
+
+        result["status"] = "migrated"
+        return result
+
+    except Exception as e:
+        print(f"[migrate_day] {event_type} {day} aborted: {e}")
+        for parts in writers.values():
+            for part in parts:
+                part.discard()
+        # Parts are live once indexing starts; the sources are then copies
+        # that must be deleted, not migrated again.
+        if uploaded and not indexed:
+            delete_keys([entry["key"] for entry in uploaded])
+        elif indexed and not keep_source:
+            result["pending_delete"] = [key for _, key in routed_sources]
+        result.update(status="failed", error=str(e))
+        return result
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Move legacy archive keys to the canonical UTC layout.")
+    ap.add_argument("--start", required=True, type=parse_day)
+    ap.add_argument("--end", required=True, type=parse_day)
+    ap.add_argument("--prefixes", default=",".join(ARCHIVE_PREFIXES))
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="days migrated in parallel")
+    ap.add_argument("--get-workers", type=int, default=DEFAULT_GET_WORKERS, help="parallel GETs per day")
+    ap.add_argument("--keep-duplicates", action="store_true")
+    ap.add_argument("--keep-source", action="store_true", help="copy only; leave legacy objects in place")
+    ap.add_argument("--dry-run", action="store_true")
+    args = ap.parse_args(argv)
+
+    run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S") + "-" + uuid.uuid4().hex[:6]
+    prefixes = [p.strip() for p in args.prefixes.split(",") if p.strip()]
+    jobs = [(event_type, day) for day in iter_days(args.start, args.end) for event_type in prefixes]
+
+    def run(job):
+        event_type, day = job
+        result = migrate_day(
+            event_type, day, run_id,
+            dedupe=not args.keep_duplicates,
+            keep_source=args.keep_source,
+            get_workers=args.get_workers,
+            dry_run=args.dry_run,
+        )
+        print("[migrate]", json.dumps(result))
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        results = list(pool.map(run, jobs))
+
+    failed = [r for r in results if r["status"] == "failed"]
+    print(json.dumps({
+        "days": len(results),
+        "records": sum(r["records"] for r in results),
+        "duplicates": sum(r["duplicates"] for r in results),
+        "unrouted": sum(r["unrouted"] for r in results),
+        "failed": len(failed),
+    }))
+    return 0 if not failed else 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
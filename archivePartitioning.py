@@ -0,0 +1,139 @@
+"""
+Canonical partitioning for the analytics bucket.
+
+Every archive writer builds its keys here so one event always lands in one
+partition, whichever Lambda archived it:
+
+    <event_type>/year=YYYY/month=MM/day=DD/hour=HH/[bucket=NN/]<ts_ms>-<thing>.json
+
+All levels are UTC and zero-padded. The optional `bucket` level spreads a
+busy hour over ARCHIVE_DEVICE_BUCKETS hashed thing_name buckets, so
+per-device reads touch one bucket instead of the whole hour; the bucket
+count is part of the layout and must not change without a migration
+(archiveMigrate.py).
+
+Keys written before this layout exist in two legacy shapes that readers
+still have to cover: unpadded container-local month/day from the IoT*ToS3
+lambdas, and zero-padded UTC day-level keys from the proxy.
+"""
+import os
+import re
+import zlib
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, Optional
+
+DEVICE_BUCKETS = int(os.environ.get("ARCHIVE_DEVICE_BUCKETS", "0"))
+
+_UNSAFE_KEY_CHARS = re.compile(r"[^A-Za-z0-9_.-]")
+_PARTITION_LEVEL = re.compile(r"(year|month|day|hour|bucket)=(\d+)")
+
+
+# ---------- WRITE SIDE ----------
+def device_bucket(thing_name: Optional[str], buckets: int = DEVICE_BUCKETS) -> int:
+    """Stable hash bucket for a thing (crc32, identical across processes)."""
+    return zlib.crc32((thing_name or "unknown").encode("utf-8")) % buckets
+
+
+def partition_prefix(event_type: str,
+                     timestamp_ms: int,
+                     thing_name: Optional[str] = None,
+                     buckets: int = DEVICE_BUCKETS) -> str:
+    dt = datetime.fromtimestamp(int(timestamp_ms) / 1000, tz=timezone.utc)
+    prefix = (
+        f"{event_type}/"
+        f"year={dt.year}/month={dt.month:02d}/day={dt.day:02d}/hour={dt.hour:02d}/"
+    )
+    if buckets > 0:
+        prefix += f"bucket={device_bucket(thing_name, buckets):02d}/"
+    return prefix
+
+
+def object_key(event_type: str,
+               timestamp_ms: int,
+               thing_name: Optional[str] = None,
+               source: Optional[str] = None,
+               buckets: int = DEVICE_BUCKETS) -> str:
+    """
+    Key for one archived event; the same event from the same writer always
+    maps to the same key. `source` keeps writers that archive a different
+    shape of the same event (the proxy stores it raw) from overwriting
+    each other.
+    """
+    name = f"{int(timestamp_ms)}-{_UNSAFE_KEY_CHARS.sub('_', thing_name or 'unknown')}"
+    if source:
+        name += f".{source}"
+    return f"{partition_prefix(event_type, timestamp_ms, thing_name, buckets)}{name}.json"
+
+
+# ---------- READ SIDE ----------
+def leaf_prefixes(event_type: str,
+                  day: date,
+                  hours: Iterable[int] = range(24),
+                  thing_names: Optional[Iterable[str]] = None,
+                  buckets: int = DEVICE_BUCKETS) -> List[str]:
+    """
+    Canonical leaf partitions for one UTC day, pruned to `hours` and, when the
+    bucket level is enabled, to the buckets of `thing_names`.
+    """
+    day_prefix = f"{event_type}/year={day.year}/month={day.month:02d}/day={day.day:02d}/"
+    if buckets > 0:
+        wanted = (sorted({device_bucket(t, buckets) for t in thing_names})
+                  if thing_names else range(buckets))
+        return [f"{day_prefix}hour={h:02d}/bucket={b:02d}/" for h in hours for b in wanted]
+    return [f"{day_prefix}hour={h:02d}/" for h in hours]
+
+
+def legacy_day_prefixes(event_type: str, day: date) -> List[str]:
+    """Pre-canonical day partitions: unpadded (IoT*ToS3) and zero-padded (proxy)."""
+    unpadded = f"{event_type}/year={day.year}/month={day.month}/day={day.day}/"
+    padded = f"{event_type}/year={day.year}/month={day.month:02d}/day={day.day:02d}/"
+    return list(dict.fromkeys([padded, unpadded]))
+
+
+def read_prefixes(event_type: str,
+                  day: date,
+                  hours: Iterable[int] = range(24),
+                  thing_names: Optional[Iterable[str]] = None,
+                  buckets: int = DEVICE_BUCKETS) -> List[str]:
+    """
+    Every partition that can hold `event_type` records for `day`.
+
+    Legacy day prefixes are read non-recursively (only keys directly under
+    them); the canonical hour/bucket leaves underneath are listed separately.
+    """
+    return legacy_day_prefixes(event_type, day) + leaf_prefixes(event_type, day, hours, thing_names, buckets)
+
+
+def discover_leaf_prefixes(s3, bucket: str, prefix: str) -> Iterator[str]:
+    """
+    Walk `prefix` with delimited LISTs and yield every prefix that directly
+    holds objects; each LIST only returns the keys directly under its level.
+    """
+    paginator = s3.get_paginator("list_objects_v2")
+    children: List[str] = []
+    has_objects = False
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+        has_objects = has_objects or bool(page.get("Contents"))
+        children.extend(cp["Prefix"] for cp in page.get("CommonPrefixes", []))
+    if has_objects:
+        yield prefix
+    for child in children:
+        yield from discover_leaf_prefixes(s3, bucket, child)
+
+
+def parse_partition(key: str) -> Dict[str, int]:
+    """Partition values encoded in a key, e.g. {'year': 2025, 'month': 12, ...}."""
+    return {name: int(value) for name, value in _PARTITION_LEVEL.findall(key)}
+
+
+def is_canonical_key(key: str) -> bool:
+    return "hour" in parse_partition(key)
+
+
+def partition_end(prefix: str) -> Optional[datetime]:
+    """UTC end of the hour (or legacy day) a partition covers; None above day level."""
+    levels = parse_partition(prefix)
+    if not {"year", "month", "day"} <= levels.keys():
+        return None
+    start = datetime(levels["year"], levels["month"], levels["day"], levels.get("hour", 0), tzinfo=timezone.utc)
+    return start + (timedelta(hours=1) if "hour" in levels else timedelta(days=1))
@@ -0,0 +1,304 @@
+"""
+Replay / backfill from the S3 analytics archive into DynamoDB.
+
+Streams archived dispense_completed and schedule_monitor events for a date
+range back through the esp32ColorLambda item builders, either as a dry run
+(count and sample the items) or written with batch_writer into a table
+with the ColorControllerEvents key schema, named with --table.
+
+Writes never go to the live table: replayed schedule monitor items are
+keyed on the archived event time, while the live Lambda keys them on
+processing time, so a replay into it would duplicate every event.
+Switching the Lambda's EVENTS_TABLE to the replayed table is the swap; it
+invalidates every cached Alexa answer, since cache entries record the table
+they were computed from.
+
+Replayed items reuse the archived event time for `timestamp` and (for
+schedule monitor events) `command_id`, so re-running a range overwrites the
+same items instead of duplicating them.
+
+Usage:
+    python archiveReplay.py --start 2025-12-01 --end 2025-12-07 --dry-run
+    python archiveReplay.py --start 2025-12-01 --end 2025-12-07 \\
+        --table ColorControllerEventsV2 --workers 32 --rate 200 \\
+        --checkpoint replay.ckpt.json
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import boto3
+
+from archiveManifest import iter_object_records, list_data_keys, plan_reads, read_trusted_manifest
+from archivePartitioning import read_prefixes
+from bulkSchedulePush import TokenBucket
+from esp32ColorLambda import (
+    build_dispense_completed_item,
+    build_schedule_monitor_item,
+    EVENTS_TABLE,
+    TTL_ATTRIBUTE,
+    dynamo,
+)
+
+# ---------- CONFIG ----------
+S3_BUCKET = "pill-dispenser-analytics-us-east-2-7375388"
+S3_REGION = "us-east-2"
+
+REPLAYABLE_PREFIXES = ("dispense_completed", "schedule_monitor")
+
+DEFAULT_WORKERS = 16
+# Keys handed to the GET pool at once; bounds memory regardless of partition size.
+FETCH_CHUNK = 256
+
+s3_client = boto3.client("s3", region_name=S3_REGION)
+
+
+# ---------- PARTITIONS ----------
+def iter_days(start: date, end: date) -> Iterator[date]:
+    day = start
+    while day <= end:
+        yield day
+        day += timedelta(days=1)
+
+
+def list_keys(prefix: str, thing_names: Optional[List[str]] = None) -> Iterator[str]:
+    """
+    Data keys in partition `prefix`, from its manifest when it is trusted
+    (sealed by the compactor; pruned to objects holding `thing_names`), else
+    from LIST.
+    """
+    manifest = read_trusted_manifest(s3_client, S3_BUCKET, prefix)
+    if manifest is not None:
+        yield from plan_reads(manifest, thing_names)
+        return
+    yield from list_data_keys(s3_client, S3_BUCKET, prefix)
+
+
+def fetch_records(key: str) -> Optional[List[Dict[str, Any]]]:
+    try:
+        return list(iter_object_records(s3_client, S3_BUCKET, key))
+    except Exception as e:
+        print(f"[fetch_records] {key}: {e}")
+        return None
+
+
+# ---------- RECORD -> ITEM ----------
+def normalize_record(event_prefix: str, record: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Map an archived record back to the IoT Rule event shape the handlers expect.
+
+    The proxy and IoTDispenseToS3 archive the raw event; IoTScheduleMonitorToS3
+    archives a reshaped document with `timestamp` and a nested `reported` map.
+    """
+    if "event_timestamp" in record:
+        return record
+
+    reported = record.get("reported") or {}
+    event = dict(record)
+    event["event_timestamp"] = record.get("timestamp")
+    if event_prefix == "schedule_monitor":
+        event.setdefault("buzzer_enabled", reported.get("buzzer_enabled", False))
+        event.setdefault("last_dispense", reported.get("last_dispense", 0))
+        event.setdefault("last_command_id", reported.get("reported_command_id", 0))
+    return event
+
+
+def build_item(event_prefix: str, record: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    event = normalize_record(event_prefix, record)
+    event_ms = event.get("event_timestamp")
+    if event_ms is None:
+        return None
+    event_ms = int(event_ms)
+    timestamp_bz = event_ms // 1000
+
+    if event_prefix == "dispense_completed":
+        if "dispensed_color" not in event and "dispense_status" not in event:
+            return None
+        item = build_dispense_completed_item(event, timestamp_bz=timestamp_bz)
+        if not event.get("command_id"):
+            item["command_id"] = event_ms
+        return item
+
+    if event_prefix == "schedule_monitor":
+        if event.get("pill_hour") is None or event.get("pill_minute") is None:
+            return None
+        return build_schedule_monitor_item(event, timestamp_bz=timestamp_bz, command_id=event_ms)
+
+    return None
+
+
+# ---------- CHECKPOINT ----------
+def load_checkpoint(path: Optional[str]) -> Dict[str, Any]:
+    if not path or not os.path.exists(path):
+        return {"completed": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: Optional[str], state: Dict[str, Any]) -> None:
+    if not path:
+        return
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+# ---------- REPLAY ----------
+def chunked(it: Iterator[str], size: int) -> Iterator[List[str]]:
+    chunk = []
+    for x in it:
+        chunk.append(x)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def replay_partition(event_prefix: str,
+                     day: date,
+                     pool: ThreadPoolExecutor,
+                     writer,
+                     bucket: Optional[TokenBucket],
+                     seen: set,
+                     stats: Dict[str, int],
+                     sample: List[Dict[str, Any]],
+                     sample_size: int) -> None:
+    for prefix in read_prefixes(event_prefix, day):
+        for keys in chunked(list_keys(prefix), FETCH_CHUNK):
+            for records in pool.map(fetch_records, keys):
+                stats["objects"] += 1
+                if records is None:
+                    stats["errors"] += 1
+                    continue
+                replay_records(event_prefix, records, writer, bucket, seen, stats, sample, sample_size)
+
+
+def replay_records(event_prefix: str,
+                   records: List[Dict[str, Any]],
+                   writer,
+                   bucket: Optional[TokenBucket],
+                   seen: set,
+                   stats: Dict[str, int],
+                   sample: List[Dict[str, Any]],
+                   sample_size: int) -> None:
+    for record in records:
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            item = build_item(event_prefix, record)
+        except Exception as e:
+            print(f"[replay_records] build failed: {e}")
+            stats["errors"] += 1
+            continue
+        if item is None:
+            stats["skipped"] += 1
+            continue
+        # Past its retention: TTL would delete it at once and re-archive it.
+        if item.get(TTL_ATTRIBUTE, float("inf")) <= time.time():
+            stats["expired"] += 1
+            continue
+        # The proxy and the IoT rule archive the same event twice.
+        pk = (item["command_id"], item["timestamp"])
+        if pk in seen:
+            stats["duplicates"] += 1
+            continue
+        seen.add(pk)
+
+        if writer is not None:
+            writer.put_item(Item=item)
+        elif len(sample) < sample_size:
+            sample.append(item)
+        stats["items"] += 1
+
+
+def replay(start: date,
+           end: date,
+           prefixes: Tuple[str, ...] = REPLAYABLE_PREFIXES,
+           table_name: Optional[str] = None,
+           dry_run: bool = True,
+           workers: int = DEFAULT_WORKERS,
+           rate: Optional[float] = None,
+           checkpoint_path: Optional[str] = None,
+           sample_size: int = 5) -> Dict[str, Any]:
+    """
+    Replay every archived partition in [start, end] for `prefixes`.
+
+    Partitions are processed in order and recorded in the checkpoint file
+    once fully written, so an interrupted run resumes at the next partition.
+    A write run needs `table_name`, and it must not be the live events table.
+    """
+    if not dry_run and (not table_name or table_name == EVENTS_TABLE):
+        raise ValueError(f"replay writes need a target table other than the live {EVENTS_TABLE}")
+    state = load_checkpoint(checkpoint_path)
+    completed = set(state.get("completed", []))
+    table = dynamo.Table(table_name) if table_name else None
+
+    stats = {"partitions": 0, "objects": 0, "items": 0, "skipped": 0, "expired": 0, "duplicates": 0, "errors": 0}
+    sample: List[Dict[str, Any]] = []
+    bucket = TokenBucket(rate, max(1, int(rate))) if rate else None
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for day in iter_days(start, end):
+            for event_prefix in prefixes:
+                partition_id = f"{event_prefix}/{day.isoformat()}"
+                if partition_id in completed:
+                    continue
+                seen: set = set()
+                if dry_run:
+                    replay_partition(event_prefix, day, pool, None, bucket, seen, stats, sample, sample_size)
+                else:
+                    with table.batch_writer() as writer:
+                        replay_partition(event_prefix, day, pool, writer, bucket, seen, stats, sample, sample_size)
+                    completed.add(partition_id)
+                    state["completed"] = sorted(completed)
+                    save_checkpoint(checkpoint_path, state)
+                stats["partitions"] += 1
+                print(f"[replay] {partition_id} done: {json.dumps(stats)}")
+
+    result = {"stats": stats, "dry_run": dry_run}
+    if dry_run:
+        result["sample"] = sample
+    return result
+
+
+# ---------- CLI ----------
+def parse_day(value: str) -> date:
+    return datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Replay archived IoT events into DynamoDB.")
+    ap.add_argument("--start", required=True, type=parse_day, help="YYYY-MM-DD (UTC partition date)")
+    ap.add_argument("--end", required=True, type=parse_day, help="YYYY-MM-DD, inclusive")
+    ap.add_argument("--prefixes", default=",".join(REPLAYABLE_PREFIXES))
+    ap.add_argument("--table", help="target table, required unless --dry-run (never EVENTS_TABLE)")
+    ap.add_argument("--dry-run", action="store_true")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="parallel S3 GETs")
+    ap.add_argument("--rate", type=float, help="max records per second")
+    ap.add_argument("--checkpoint", help="resume file; completed partitions are skipped")
+    args = ap.parse_args(argv)
+
+    prefixes = tuple(p.strip() for p in args.prefixes.split(",") if p.strip())
+    unknown = set(prefixes) - set(REPLAYABLE_PREFIXES)
+    if unknown:
+        ap.error(f"cannot replay prefixes: {', '.join(sorted(unknown))}")
+    if not args.dry_run and (not args.table or args.table == EVENTS_TABLE):
+        ap.error(f"--table is required unless --dry-run, and must not be the live {EVENTS_TABLE}")
+
+    result = replay(
+        args.start, args.end, prefixes,
+        table_name=args.table, dry_run=args.dry_run,
+        workers=args.workers, rate=args.rate, checkpoint_path=args.checkpoint,
+    )
+    print(json.dumps(result, default=str, indent=2))
+    return 0 if result["stats"]["errors"] == 0 else 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
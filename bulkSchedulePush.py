@@ -0,0 +1,298 @@
+"""
+Fleet-wide schedule push.
+
+Applies one pill schedule to many things at once using the same shadow
+payload and schedule_update event as SetPillTimeIntent in esp32ColorLambda.
+
+Usage:
+    python bulkSchedulePush.py --pill-name Aspirin --color RED --time "8 AM" \\
+        --things esp32-a,esp32-b
+    python bulkSchedulePush.py --pill-name Aspirin --color RED --time 20:30 --all-users
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+from boto3.dynamodb.conditions import Key
+from botocore.exceptions import ClientError
+
+from esp32ColorLambda import (
+    VALID_COLORS,
+    build_schedule_shadow_payload,
+    build_schedule_update_item,
+    events_table,
+    invalidate_user_cache,
+    iot,
+    parse_alexa_time,
+    user_table,
+)
+
+# ---------- CONFIG ----------
+# UpdateThingShadow is throttled per account (thousands of TPS) and per thing
+# (20 TPS); stay well below the account limit so interactive Alexa traffic
+# sharing the same quota keeps working during a push.
+DEFAULT_RATE_PER_SEC = 50.0
+DEFAULT_BURST = 20
+DEFAULT_WORKERS = 16
+
+MAX_ATTEMPTS = 6
+BASE_BACKOFF_SEC = 0.2
+MAX_BACKOFF_SEC = 10.0
+
+THROTTLE_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "RequestLimitExceeded",
+    "ProvisionedThroughputExceededException",
+    "ServiceUnavailableException",
+}
+
+
+# ---------- RATE LIMITING ----------
+class TokenBucket:
+    """Thread-safe token bucket: `rate` tokens per second, at most `burst` banked."""
+
+    def __init__(self, rate: float, burst: int):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = float(rate)
+        self.capacity = float(max(1, burst))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class CommandIdClock:
+    """
+    Command ids in the same epoch-ms space the Lambda uses: unique within this
+    process and never ahead of the wall clock, so they cannot take an id a
+    live command will be given later.
+    """
+
+    def __init__(self):
+        self._last = 0
+        self._lock = threading.Lock()
+
+    def next(self) -> int:
+        with self._lock:
+            while True:
+                now = int(time.time() * 1000)
+                if now > self._last:
+                    self._last = now
+                    return now
+                time.sleep(0.0005)
+
+
+def is_throttle_error(exc: Exception) -> bool:
+    if isinstance(exc, ClientError):
+        return exc.response.get("Error", {}).get("Code") in THROTTLE_ERROR_CODES
+    return False
+
+
+def call_with_backoff(fn: Callable[[], Any],
+                      bucket: Optional[TokenBucket] = None,
+                      max_attempts: int = MAX_ATTEMPTS) -> Any:
+    """Call `fn`, retrying throttled calls with full-jitter exponential backoff."""
+    for attempt in range(max_attempts):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            return fn()
+        except Exception as e:
+            if not is_throttle_error(e) or attempt == max_attempts - 1:
+                raise
+            delay = random.uniform(0, min(MAX_BACKOFF_SEC, BASE_BACKOFF_SEC * (2 ** attempt)))
+            print(f"[call_with_backoff] throttled (attempt {attempt + 1}), sleeping {delay:.2f}s")
+            time.sleep(delay)
+
+
+# ---------- TARGET RESOLUTION ----------
+def things_for_users(user_ids: Iterable[str]) -> List[Tuple[str, str]]:
+    """Return (thing_name, user_id) pairs mapped to the given users in UserThings."""
+    targets = []
+    for user_id in user_ids:
+        kwargs = {"KeyConditionExpression": Key("user_id").eq(user_id)}
+        while True:
+            resp = user_table.query(**kwargs)
+            targets.extend((item["thing_name"], user_id) for item in resp.get("Items", []))
+            if "LastEvaluatedKey" not in resp:
+                break
+            kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    return targets
+
+
+def owners_for_things(thing_names: Iterable[str]) -> List[Tuple[str, str]]:
+    """
+    Return (thing_name, user_id) pairs for the owners of the given things, so
+    the events are visible to their Alexa intents. Things without an owner in
+    UserThings are kept as user SYSTEM.
+    """
+    wanted = list(dict.fromkeys(thing_names))
+    wanted_set = set(wanted)
+    owned = [(thing, user_id) for thing, user_id in all_user_things() if thing in wanted_set]
+    found = {thing for thing, _ in owned}
+    for thing in wanted:
+        if thing not in found:
+            print(f"[owners_for_things] {thing} has no owner in UserThings; logging as SYSTEM")
+            owned.append((thing, "SYSTEM"))
+    return owned
+
+
+def all_user_things() -> List[Tuple[str, str]]:
+    """Return every (thing_name, user_id) pair in UserThings."""
+    targets = []
+    kwargs = {"ProjectionExpression": "user_id, thing_name"}
+    while True:
+        resp = user_table.scan(**kwargs)
+        targets.extend((item["thing_name"], item["user_id"]) for item in resp.get("Items", []))
+        if "LastEvaluatedKey" not in resp:
+            break
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    return targets
+
+
+# ---------- PUSH ----------
+def push_schedule(targets: List[Tuple[str, str]],
+                  pill_name: str,
+                  color: str,
+                  hour: int,
+                  minute: int,
+                  buzzer_enabled: bool = True,
+                  workers: int = DEFAULT_WORKERS,
+                  rate: float = DEFAULT_RATE_PER_SEC,
+                  burst: int = DEFAULT_BURST,
+                  dry_run: bool = False) -> Dict[str, Any]:
+    """
+    Push one schedule to every (thing_name, user_id) target.
+
+    Shadow updates run on a bounded worker pool behind a shared token bucket;
+    schedule_update events for the things that accepted the update are then
+    written in one batch_writer pass.
+    """
+    color = color.upper()
+    if color not in VALID_COLORS:
+        raise ValueError(f"invalid color {color}; valid: {', '.join(sorted(VALID_COLORS))}")
+
+    # De-duplicate while preserving order: a thing shared by several users
+    # only needs one shadow update but one event per user.
+    unique_things = list(dict.fromkeys(thing for thing, _ in targets))
+    clock = CommandIdClock()
+    command_ids: Dict[str, int] = {}
+
+    bucket = TokenBucket(rate, burst)
+
+    def push_one(thing_name: str) -> Tuple[str, Optional[str]]:
+        # Allocated at push time, like SetPillTimeIntent does
+        command_ids[thing_name] = clock.next()
+        payload = build_schedule_shadow_payload(
+            pill_name, color, hour, minute, command_ids[thing_name], buzzer_enabled
+        )
+        if dry_run:
+            return thing_name, None
+        try:
+            call_with_backoff(
+                lambda: iot.update_thing_shadow(thingName=thing_name, payload=json.dumps(payload)),
+                bucket,
+            )
+            return thing_name, None
+        except Exception as e:
+            print(f"[push_schedule] {thing_name} failed: {e}")
+            return thing_name, str(e)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = dict(pool.map(push_one, unique_things))
+
+    succeeded = [thing for thing, err in results.items() if err is None]
+    failed = {thing: err for thing, err in results.items() if err is not None}
+
+    events_written = 0
+    if not dry_run:
+        ok = set(succeeded)
+        logged = set()
+        users = set()
+        with events_table.batch_writer() as batch:
+            for thing_name, user_id in targets:
+                if thing_name not in ok:
+                    continue
+                # The first event of a thing carries its shadow command_id (as
+                # SetPillTimeIntent does, so dispense reports resolve by id);
+                # extra users of a shared thing need their own event key.
+                command_id = command_ids[thing_name] if thing_name not in logged else clock.next()
+                logged.add(thing_name)
+                batch.put_item(Item=build_schedule_update_item(
+                    command_id, thing_name, user_id, pill_name, color, hour, minute, buzzer_enabled
+                ))
+                users.add(user_id)
+                events_written += 1
+        # Cached Alexa answers for these users predate the new schedule
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(invalidate_user_cache, sorted(users)))
+
+    summary = {
+        "targets": len(unique_things),
+        "succeeded": len(succeeded),
+        "failed": failed,
+        "events_written": events_written,
+        "dry_run": dry_run,
+    }
+    print("[push_schedule] summary:", json.dumps(summary))
+    return summary
+
+
+# ---------- CLI ----------
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Push one pill schedule to many dispensers.")
+    ap.add_argument("--pill-name", required=True)
+    ap.add_argument("--color", required=True, help=", ".join(sorted(VALID_COLORS)))
+    ap.add_argument("--time", required=True, help='e.g. "8 AM", "20:30"')
+    ap.add_argument("--no-buzzer", action="store_true")
+    target = ap.add_mutually_exclusive_group(required=True)
+    target.add_argument("--things", help="comma-separated thing names (logged for their UserThings owners)")
+    target.add_argument("--users", help="comma-separated user_ids resolved through UserThings")
+    target.add_argument("--all-users", action="store_true", help="every thing in UserThings")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    ap.add_argument("--rate", type=float, default=DEFAULT_RATE_PER_SEC, help="shadow updates per second")
+    ap.add_argument("--burst", type=int, default=DEFAULT_BURST)
+    ap.add_argument("--dry-run", action="store_true")
+    args = ap.parse_args(argv)
+
+    hour, minute = parse_alexa_time(args.time)
+
+    if args.things:
+        targets = owners_for_things(t.strip() for t in args.things.split(",") if t.strip())
+    elif args.users:
+        targets = things_for_users(u.strip() for u in args.users.split(",") if u.strip())
+    else:
+        targets = all_user_things()
+
+    if not targets:
+        print("No target things found.")
+        return 1
+
+    summary = push_schedule(
+        targets, args.pill_name, args.color, hour, minute,
+        buzzer_enabled=not args.no_buzzer,
+        workers=args.workers, rate=args.rate, burst=args.burst,
+        dry_run=args.dry_run,
+    )
+    return 0 if not summary["failed"] else 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,340 @@
+"""
+Color-sensor drift analysis over archived dispense_completed events.
+
+Loads a date range of archived dispense events into flat NumPy columns and
+computes, without per-row Python loops:
+
+  * per-device confusion matrices of dispensed_color vs dominant_color,
+  * per-color RGB centroids for the fleet and per-device offsets from them,
+  * centroid drift per period, with a weighted linear trend per channel,
+  * recommended nearest-centroid thresholds for ColorSensor, in the same
+    0-255 normalized scale as ColorSensor::readNormalizedRGB().
+
+The firmware currently reports dominant_color = dispensed_color, so the
+confusion matrices only become informative once the device classifies the
+sensed RGB; the centroids and thresholds are computed from dispensed_color
+as ground truth and are what that classifier should use.
+
+Usage:
+    python colorDriftAnalysis.py --start 2025-10-01 --end 2025-12-31 --period-days 7
+    python colorDriftAnalysis.py --start 2025-12-01 --end 2025-12-31 --things esp32-a --header
+"""
+import argparse
+import json
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional
+
+import numpy as np
+
+from archivePartitioning import read_prefixes
+from archiveReplay import chunked, fetch_records, iter_days, list_keys, parse_day
+from esp32ColorLambda import DISPENSE_ANGLES
+
+# ---------- CONFIG ----------
+COLORS = tuple(DISPENSE_ANGLES) + ("UNKNOWN",)
+COLOR_INDEX = {c: i for i, c in enumerate(COLORS)}
+UNKNOWN = COLOR_INDEX["UNKNOWN"]
+
+DEFAULT_WORKERS = 16
+FETCH_CHUNK = 256
+DAY_MS = 24 * 3600 * 1000
+# Rows per block when computing the (rows x colors) distance matrix.
+DISTANCE_BLOCK = 1_000_000
+
+
+class DispenseArrays(NamedTuple):
+    things: np.ndarray         # (T,) thing names
+    thing_idx: np.ndarray      # (N,) int32 index into things
+    dispensed_idx: np.ndarray  # (N,) int8 index into COLORS
+    dominant_idx: np.ndarray   # (N,) int8 index into COLORS
+    rgb: np.ndarray            # (N, 3) float32
+    ts_ms: np.ndarray          # (N,) int64 event timestamp
+
+
+# ---------- LOADING ----------
+class _ColumnBuilder:
+    """Appends records into typed arrays; converted to NumPy once at the end."""
+
+    def __init__(self):
+        self.thing_index: Dict[str, int] = {}
+        self.thing = array("i")
+        self.dispensed = array("b")
+        self.dominant = array("b")
+        self.r = array("f")
+        self.g = array("f")
+        self.b = array("f")
+        self.ts = array("q")
+
+    def extend(self, records: Iterable[Dict[str, Any]], wanted: Optional[set] = None) -> None:
+        thing_index = self.thing_index
+        for rec in records:
+            thing = rec.get("thing_name") or "unknown"
+            ts = rec.get("event_timestamp")
+            if ts is None or (wanted is not None and thing not in wanted):
+                continue
+            idx = thing_index.setdefault(thing, len(thing_index))
+            self.thing.append(idx)
+            self.dispensed.append(COLOR_INDEX.get(str(rec.get("dispensed_color", "")).upper(), UNKNOWN))
+            self.dominant.append(COLOR_INDEX.get(str(rec.get("dominant_color", "")).upper(), UNKNOWN))
+            self.r.append(float(rec.get("r") or 0))
+            self.g.append(float(rec.get("g") or 0))
+            self.b.append(float(rec.get("b") or 0))
+            self.ts.append(int(ts))
+
+    def finish(self) -> DispenseArrays:
+        things = np.array(sorted(self.thing_index, key=self.thing_index.get), dtype=object)
+        return dedupe(DispenseArrays(
+            things=things,
+            thing_idx=np.frombuffer(self.thing, dtype=np.int32),
+            dispensed_idx=np.frombuffer(self.dispensed, dtype=np.int8),
+            dominant_idx=np.frombuffer(self.dominant, dtype=np.int8),
+            rgb=np.column_stack([np.frombuffer(c, dtype=np.float32) for c in (self.r, self.g, self.b)])
+            if len(self.ts) else np.empty((0, 3), dtype=np.float32),
+            ts_ms=np.frombuffer(self.ts, dtype=np.int64),
+        ))
+
+
+def arrays_from_records(records: Iterable[Dict[str, Any]]) -> DispenseArrays:
+    builder = _ColumnBuilder()
+    builder.extend(records)
+    return builder.finish()
+
+
+def dedupe(a: DispenseArrays) -> DispenseArrays:
+    """Drop events archived twice (proxy + IoT rule): same thing, same timestamp."""
+    if not len(a.ts_ms):
+        return a
+    key = (a.thing_idx.astype(np.int64) << 42) | a.ts_ms
+    _, first = np.unique(key, return_index=True)
+    if len(first) == len(key):
+        return a
+    first.sort()
+    return DispenseArrays(a.things, a.thing_idx[first], a.dispensed_idx[first],
+                          a.dominant_idx[first], a.rgb[first], a.ts_ms[first])
+
+
+def load_dispense_arrays(start: date,
+                         end: date,
+                         thing_names: Optional[List[str]] = None,
+                         workers: int = DEFAULT_WORKERS) -> DispenseArrays:
+    """Load archived dispense_completed events in [start, end] (UTC days)."""
+    builder = _ColumnBuilder()
+    wanted = set(thing_names) if thing_names else None
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        for day in iter_days(start, end):
+            for prefix in read_prefixes("dispense_completed", day, thing_names=thing_names):
+                for keys in chunked(list_keys(prefix, thing_names), FETCH_CHUNK):
+                    for records in pool.map(fetch_records, keys):
+                        if records:
+                            builder.extend(records, wanted)
+    return builder.finish()
+
+
+# ---------- ANALYSES ----------
+def group_centroids(group_idx: np.ndarray, n_groups: int, rgb: np.ndarray):
+    """(counts (G,), centroids (G, 3)); centroids are NaN for empty groups."""
+    counts = np.bincount(group_idx, minlength=n_groups)
+    sums = np.stack(
+        [np.bincount(group_idx, weights=rgb[:, k], minlength=n_groups) for k in range(3)],
+        axis=1,
+    )
+    with np.errstate(invalid="ignore", divide="ignore"):
+        centroids = sums / counts[:, None]
+    return counts, centroids
+
+
+def confusion_matrices(a: DispenseArrays) -> np.ndarray:
+    """(T, C, C) counts; rows are dispensed_color, columns dominant_color."""
+    n_things, n_colors = len(a.things), len(COLORS)
+    flat = (a.thing_idx.astype(np.int64) * n_colors + a.dispensed_idx) * n_colors + a.dominant_idx
+    return np.bincount(flat, minlength=n_things * n_colors * n_colors).reshape(n_things, n_colors, n_colors)
+
+
+def mismatch_rates(confusion: np.ndarray) -> np.ndarray:
+    total = confusion.sum(axis=(1, 2))
+    correct = np.trace(confusion, axis1=1, axis2=2)
+    return np.divide(total - correct, total, out=np.zeros(len(total)), where=total > 0)
+
+
+def device_offsets(a: DispenseArrays, fleet_centroids: np.ndarray):
+    """
+    (counts (T, C), distance (T, C)): how far each device's centroid for a
+    color sits from the fleet centroid of that color.
+    """
+    n_things, n_colors = len(a.things), len(COLORS)
+    group = a.thing_idx.astype(np.int64) * n_colors + a.dispensed_idx
+    counts, centroids = group_centroids(group, n_things * n_colors, a.rgb)
+    offsets = centroids.reshape(n_things, n_colors, 3) - fleet_centroids[None, :, :]
+    return counts.reshape(n_things, n_colors), np.linalg.norm(offsets, axis=2)
+
+
+def centroid_drift(a: DispenseArrays, fleet_centroids: np.ndarray, period_ms: int) -> Dict[str, np.ndarray]:
+    """
+    Per-color centroid for each period, its distance from the whole-range
+    centroid, and a count-weighted linear trend (RGB units per period).
+    """
+    n_colors = len(COLORS)
+    t0 = a.ts_ms.min()
+    period = ((a.ts_ms - t0) // period_ms).astype(np.int64)
+    n_periods = int(period.max()) + 1
+    counts, centroids = group_centroids(a.dispensed_idx.astype(np.int64) * n_periods + period,
+                                        n_colors * n_periods, a.rgb)
+    counts = counts.reshape(n_colors, n_periods)
+    centroids = centroids.reshape(n_colors, n_periods, 3)
+    distance = np.linalg.norm(centroids - fleet_centroids[:, None, :], axis=2)
+
+    # Weighted least squares slope of centroid vs period index, per color/channel.
+    w = counts.astype(np.float64)
+    x = np.arange(n_periods, dtype=np.float64)[None, :]
+    w_sum = w.sum(axis=1, keepdims=True)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        x_mean = (w * x).sum(axis=1, keepdims=True) / w_sum
+        y = np.nan_to_num(centroids)
+        y_mean = (w[:, :, None] * y).sum(axis=1, keepdims=True) / w_sum[:, :, None]
+        dx = (x - x_mean)
+        num = (w[:, :, None] * dx[:, :, None] * (y - y_mean)).sum(axis=1)
+        den = (w * dx * dx).sum(axis=1)[:, None]
+        slope = num / den
+
+    return {
+        "period_start_ms": t0 + np.arange(n_periods, dtype=np.int64) * period_ms,
+        "counts": counts,
+        "centroids": centroids,
+        "distance": distance,
+        "slope": slope,
+    }
+
+
+def recommend_thresholds(a: DispenseArrays, quantile: float = 0.95) -> Dict[str, Any]:
+    """
+    Nearest-centroid thresholds: per color, its centroid and the radius that
+    covers `quantile` of its own samples; plus the accuracy that classifier
+    would have had on the loaded events.
+    """
+    n_colors = len(COLORS)
+    known = a.dispensed_idx != UNKNOWN
+    disp = a.dispensed_idx[known].astype(np.int64)
+    rgb = a.rgb[known]
+    counts, centroids = group_centroids(disp, n_colors, rgb)
+
+    # Per-color quantile of distance to own centroid: sort by (color, distance)
+    # once, then index each color's run at its quantile position.
+    own = np.linalg.norm(rgb - centroids[disp], axis=1)
+    sorted_own = own[np.lexsort((own, disp))]
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    pick = starts + np.floor(quantile * np.maximum(counts - 1, 0)).astype(np.int64)
+    radius = np.full(n_colors, np.nan)
+    has = counts > 0
+    radius[has] = sorted_own[pick[has]]
+
+    present = np.flatnonzero(counts > 0)
+    correct = 0
+    for lo in range(0, len(rgb), DISTANCE_BLOCK):
+        block = rgb[lo:lo + DISTANCE_BLOCK]
+        d = np.linalg.norm(block[:, None, :] - centroids[None, present, :], axis=2)
+        correct += int(np.count_nonzero(present[d.argmin(axis=1)] == disp[lo:lo + DISTANCE_BLOCK]))
+
+    return {
+        "quantile": quantile,
+        "colors": {
+            COLORS[c]: {
+                "samples": int(counts[c]),
+                "centroid": [round(float(v), 1) for v in centroids[c]],
+                "radius": round(float(radius[c]), 1),
+            }
+            for c in present
+        },
+        "nearest_centroid_accuracy": correct / len(rgb) if len(rgb) else None,
+    }
+
+
+def firmware_header(thresholds: Dict[str, Any]) -> str:
+    """C table for ColorSensor, in readNormalizedRGB() units."""
+    lines = [
+        "// Generated by colorDriftAnalysis.py - nearest-centroid color thresholds",
+        "struct ColorCentroid { const char* name; int r; int g; int b; int radius; };",
+        "static const ColorCentroid COLOR_CENTROIDS[] = {",
+    ]
+    for name, t in thresholds["colors"].items():
+        r, g, b = (int(round(v)) for v in t["centroid"])
+        lines.append(f'  {{"{name}", {r}, {g}, {b}, {int(round(t["radius"]))}}},')
+    lines.append("};")
+    return "\n".join(lines)
+
+
+# ---------- REPORT ----------
+def analyze(a: DispenseArrays, period_days: int = 7, quantile: float = 0.95, top: int = 20) -> Dict[str, Any]:
+    if not len(a.ts_ms):
+        return {"events": 0}
+
+    confusion = confusion_matrices(a)
+    rates = mismatch_rates(confusion)
+    fleet_counts, fleet_centroids = group_centroids(a.dispensed_idx.astype(np.int64), len(COLORS), a.rgb)
+    offset_counts, offsets = device_offsets(a, fleet_centroids)
+    drift = centroid_drift(a, fleet_centroids, period_days * DAY_MS)
+    thresholds = recommend_thresholds(a, quantile)
+
+    worst = np.argsort(-rates)[:top]
+    # Largest per-device offset over colors with enough samples to trust.
+    trusted = (offset_counts >= 5) & ~np.isnan(offsets)
+    max_offset = np.where(trusted, offsets, -np.inf).max(axis=1)
+    drifting = np.argsort(-max_offset)[:top]
+
+    return {
+        "events": int(len(a.ts_ms)),
+        "devices": int(len(a.things)),
+        "colors": list(COLORS),
+        "fleet_centroids": {
+            COLORS[c]: [round(float(v), 1) for v in fleet_centroids[c]]
+            for c in np.flatnonzero(fleet_counts)
+        },
+        "worst_mismatch": [
+            {"thing_name": a.things[i], "mismatch_rate": round(float(rates[i]), 4),
+             "events": int(confusion[i].sum()), "confusion": confusion[i].tolist()}
+            for i in worst if confusion[i].sum()
+        ],
+        "largest_offsets": [
+            {"thing_name": a.things[i], "max_offset": round(float(max_offset[i]), 1)}
+            for i in drifting if np.isfinite(max_offset[i])
+        ],
+        "drift": {
+            "period_days": period_days,
+            "period_start_ms": drift["period_start_ms"].tolist(),
+            "distance": {
+                COLORS[c]: [None if np.isnan(v) else round(float(v), 1) for v in drift["distance"][c]]
+                for c in np.flatnonzero(fleet_counts)
+            },
+            "slope_per_period": {
+                COLORS[c]: [round(float(v), 3) for v in drift["slope"][c]]
+                for c in np.flatnonzero(fleet_counts)
+            },
+        },
+        "thresholds": thresholds,
+    }
+
+
+# ---------- CLI ----------
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Analyse color-sensor drift over archived dispense events.")
+    ap.add_argument("--start", required=True, type=parse_day)
+    ap.add_argument("--end", required=True, type=parse_day)
+    ap.add_argument("--things", help="comma-separated thing names (default: whole fleet)")
+    ap.add_argument("--period-days", type=int, default=7)
+    ap.add_argument("--quantile", type=float, default=0.95, help="share of samples inside each color radius")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    ap.add_argument("--header", action="store_true", help="also print the firmware centroid table")
+    args = ap.parse_args(argv)
+
+    things = [t.strip() for t in args.things.split(",") if t.strip()] if args.things else None
+    arrays = load_dispense_arrays(args.start, args.end, things, args.workers)
+    report = analyze(arrays, args.period_days, args.quantile)
+    print(json.dumps(report, indent=2, default=str))
+    if args.header and report.get("thresholds"):
+        print(firmware_header(report["thresholds"]))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,41 @@
+"""
+Native-number conversion between DynamoDB wire items and plain Python.
+
+Shared by esp32ColorLambda (low-level client reads and writes) and
+EventsTtlToS3 (stream images), so neither goes through Decimal. Kept free
+of AWS clients so a Lambda can import it without creating any.
+"""
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+
+
+class NativeDeserializer(TypeDeserializer):
+    """Deserialize DynamoDB numbers straight to int/float instead of Decimal."""
+
+    def _deserialize_n(self, value):
+        if '.' in value or 'e' in value or 'E' in value:
+            return float(value)
+        return int(value)
+
+    def _deserialize_ns(self, value):
+        return set(map(self._deserialize_n, value))
+
+
+class NativeSerializer(TypeSerializer):
+    """TypeSerializer that also accepts floats (written as DynamoDB numbers)."""
+
+    def serialize(self, value):
+        if isinstance(value, float):
+            return {'N': repr(value)}
+        return super().serialize(value)
+
+
+_deserializer = NativeDeserializer()
+_serializer = NativeSerializer()
+
+
+def to_item(attrs):
+    return {k: _deserializer.deserialize(v) for k, v in attrs.items()}
+
+
+def from_item(item):
+    return {k: _serializer.serialize(v) for k, v in item.items()}
@@ -5,21 +5,65 @@ import time
 import traceback
 import re
 from datetime import datetime, timezone, timedelta
-from decimal import Decimal
 
 import boto3
-from boto3.dynamodb.conditions import Key, Attr
+from boto3.dynamodb.conditions import Key, Attr, ConditionExpressionBuilder
 from dateutil import parser
 
+from dynamoTypes import from_item, to_item
+from invocationProfiler import profiled
+from lambdaWarmup import handle_warmup, is_warmup_event
+
 # ----- Configuration via environment variables -----
 USER_TABLE = os.environ.get('USER_TABLE', 'UserThings')
 EVENTS_TABLE = os.environ.get('EVENTS_TABLE', 'ColorControllerEvents')
+STATS_TABLE = os.environ.get('STATS_TABLE', 'ColorSensorStats')
+CACHE_TABLE = os.environ.get('CACHE_TABLE', 'UserResponseCache')
 IOT_REGION = os.environ.get('IOT_REGION', 'us-east-2')
 
+# Rolling color-sensor window per (thing_name, color) item of STATS_TABLE:
+# STATS_SLOTS buckets of STATS_SLOT_SECONDS each.
+STATS_SLOTS = int(os.environ.get('STATS_SLOTS', '24'))
+STATS_SLOT_SECONDS = int(os.environ.get('STATS_SLOT_SECONDS', '3600'))
+MISMATCH_ALERT_RATE = float(os.environ.get('MISMATCH_ALERT_RATE', '0.2'))
+COLOR_ALERT_MIN_SAMPLES = int(os.environ.get('COLOR_ALERT_MIN_SAMPLES', '20'))
+COLOR_ALERT_COOLDOWN = int(os.environ.get('COLOR_ALERT_COOLDOWN', '3600'))
+# Expected sensor RGB per dispensed color, e.g. the fleet_centroids reported by
+# colorDriftAnalysis: {"RED": [255, 60, 52], ...}. Colors without an entry
+# get no drift alert.
+EXPECTED_COLOR_RGB = json.loads(os.environ.get('EXPECTED_COLOR_RGB', '{}'))
+DRIFT_ALERT_DISTANCE = float(os.environ.get('DRIFT_ALERT_DISTANCE', '40'))
+
+# Read-intent cache entries are validated against the user's version counter;
+# the max age only bounds staleness if a version bump was ever lost.
+CACHE_MAX_AGE = int(os.environ.get('CACHE_MAX_AGE', '86400'))
+
+# User -> device mappings are kept per container for DEVICE_CACHE_TTL seconds
+DEVICE_CACHE_TTL = int(os.environ.get('DEVICE_CACHE_TTL', '300'))
+# Warm-up pings pre-load at most this many mappings, and only once per TTL
+WARMUP_PRELOAD_LIMIT = int(os.environ.get('WARMUP_PRELOAD_LIMIT', '1000'))
+
+# Hot-table retention per event_type, in days (None = keep). Expired items are
+# removed by DynamoDB TTL and archived to S3 by EventsTtlToS3 from the stream.
+# schedule_update is kept: it is the source of truth for schedule lookups.
+# Items written before retention existed are stamped by retentionBackfill.py.
+TTL_ATTRIBUTE = os.environ.get('TTL_ATTRIBUTE', 'expires_at')
+RETENTION_DAYS = {
+    'scheduled_time_monitor': 7,
+    'color_mismatch_alert': 90,
+    'color_drift_alert': 90,
+    'dispense_request': 180,
+    'dispense_completed': 365,
+    'schedule_update': None,
+}
+RETENTION_DAYS.update(json.loads(os.environ.get('EVENT_RETENTION_DAYS', '{}')))
+
 # ----- AWS clients -----
 dynamo = boto3.resource('dynamodb', region_name=os.environ.get('DDB_REGION', 'us-east-1'))
 user_table = dynamo.Table(USER_TABLE)
 events_table = dynamo.Table(EVENTS_TABLE)
+# Low-level client (shares the resource's connection pool) for the hot paths
+ddb = dynamo.meta.client
 
 iot = boto3.client('iot-data', region_name=IOT_REGION)
 
@@ -59,15 +103,130 @@ def format_time_12h(hour, minute):
     return f"{display_hour}:{minute:02d} {period}"
 
 
-def convert_decimals(obj):
-    """Convert DynamoDB Decimal types to Python native types for JSON serialization."""
-    if isinstance(obj, list):
-        return [convert_decimals(i) for i in obj]
-    elif isinstance(obj, dict):
-        return {k: convert_decimals(v) for k, v in obj.items()}
-    elif isinstance(obj, Decimal):
-        return int(obj) if obj % 1 == 0 else float(obj)
-    return obj
+def with_retention(item):
+    """Stamp the TTL attribute on an events item according to RETENTION_DAYS."""
+    days = RETENTION_DAYS.get(item.get('event_type'))
+    if days:
+        item[TTL_ATTRIBUTE] = int(item['timestamp']) + int(days) * 86400
+    return item
+
+
+# Single shared encoder: serialize each payload once and reuse the string
+JSON_ENCODER = json.JSONEncoder(default=str)
+
+
+def encode_json(obj):
+    return JSON_ENCODER.encode(obj)
+
+
+# ---------------- Data access (low-level client, native numbers) ----------------
+_expression_builder = ConditionExpressionBuilder()
+
+
+def _condition_kwargs(key_condition=None, filter_expression=None):
+    """Translate boto3 Key/Attr conditions into low-level client arguments."""
+    kwargs, names, values = {}, {}, {}
+    _expression_builder.reset()
+    for arg, cond, is_key in (('KeyConditionExpression', key_condition, True),
+                              ('FilterExpression', filter_expression, False)):
+        if cond is None:
+            continue
+        built = _expression_builder.build_expression(cond, is_key_condition=is_key)
+        kwargs[arg] = built.condition_expression
+        names.update(built.attribute_name_placeholders)
+        values.update(built.attribute_value_placeholders)
+    if names:
+        kwargs['ExpressionAttributeNames'] = names
+    if values:
+        kwargs['ExpressionAttributeValues'] = from_item(values)
+    return kwargs
+
+
+def query_items(table_name, key_condition, filter_expression=None, **kwargs):
+    resp = ddb.query(TableName=table_name, **_condition_kwargs(key_condition, filter_expression), **kwargs)
+    return [to_item(i) for i in resp.get('Items', [])]
+
+
+def scan_items(table_name, filter_expression=None, **kwargs):
+    resp = ddb.scan(TableName=table_name, **_condition_kwargs(None, filter_expression), **kwargs)
+    return [to_item(i) for i in resp.get('Items', [])]
+
+
+def put_event(item):
+    ddb.put_item(TableName=EVENTS_TABLE, Item=from_item(item))
+
+
+# ---------------- Response cache ----------------
+# One CACHE_TABLE item per user: {'user_id', 'version', <intent>: entry}.
+# Every write that can change a read-intent answer bumps 'version'; an entry
+# is valid only while its own version matches, so a hit costs one GetItem.
+# Entries also record the EVENTS_TABLE they were computed from, so pointing
+# EVENTS_TABLE at another table (e.g. a backfilled copy) invalidates them all.
+def read_user_cache(user_id):
+    try:
+        resp = ddb.get_item(TableName=CACHE_TABLE, Key=from_item({'user_id': user_id}))
+        return to_item(resp.get('Item', {}))
+    except Exception as e:
+        print(f"[read_user_cache] {user_id}: {e}")
+        return None
+
+
+def cached_entry(cache, intent):
+    """The cached entry for `intent` if it was computed at the current version."""
+    if not cache:
+        return None
+    entry = cache.get(intent)
+    if (entry and entry.get('version') == cache.get('version', 0)
+            and entry.get('source') == EVENTS_TABLE
+            and now_bz_epoch_seconds() - entry.get('cached_at', 0) < CACHE_MAX_AGE):
+        return entry
+    return None
+
+
+def store_cache_entry(user_id, intent, cache, entry):
+    """
+    Store an entry computed from the data seen at the cache's version. The
+    write is conditional on that version, so an answer that raced with a
+    bump is dropped instead of cached.
+    """
+    if cache is None:
+        return
+    version = cache.get('version', 0)
+    values = {':entry': {**entry, 'version': version, 'source': EVENTS_TABLE,
+                         'cached_at': now_bz_epoch_seconds()}}
+    if version:
+        condition = '#v = :v'
+        values[':v'] = version
+    else:
+        condition = 'attribute_not_exists(#v)'
+    try:
+        ddb.update_item(
+            TableName=CACHE_TABLE,
+            Key=from_item({'user_id': user_id}),
+            UpdateExpression='SET #i = :entry',
+            ConditionExpression=condition,
+            ExpressionAttributeNames={'#v': 'version', '#i': intent},
+            ExpressionAttributeValues=from_item(values)
+        )
+    except ddb.exceptions.ConditionalCheckFailedException:
+        pass
+    except Exception as e:
+        print(f"[store_cache_entry] {user_id} {intent}: {e}")
+
+
+def invalidate_user_cache(user_id):
+    """Bump the user's version; call after the write is persisted."""
+    try:
+        ddb.update_item(
+            TableName=CACHE_TABLE,
+            Key=from_item({'user_id': user_id}),
+            UpdateExpression='ADD #v :one',
+            ExpressionAttributeNames={'#v': 'version'},
+            ExpressionAttributeValues=from_item({':one': 1})
+        )
+    except Exception as e:
+        print(f"[invalidate_user_cache] {user_id}: {e}")
+        log_exception()
 
 
 # ---------------- Time parsing ----------------
@@ -160,14 +319,56 @@ def build_response_with_session(text, session_attrs=None, end_session=False):
     }
 
 
+# ---------------- Schedule payload builders ----------------
+def build_schedule_shadow_payload(pill_name, color, hour, minute, command_id, buzzer_enabled=True):
+    """Shadow desired-state document the device applies as its pill schedule."""
+    return {
+        "state": {
+            "desired": {
+                "pill_name": pill_name,
+                "color": color,
+                "pill_hour": hour,
+                "pill_minute": minute,
+                "buzzer_enabled": buzzer_enabled,
+                "command_id": command_id
+            }
+        }
+    }
+
+
+def build_schedule_update_item(command_id, thing_name, user_id, pill_name, color, hour, minute,
+                               buzzer_enabled=True):
+    """ColorControllerEvents item logged for every schedule pushed to a device."""
+    return with_retention({
+        'command_id': command_id,
+        'timestamp': now_bz_epoch_seconds(),
+        'thing_name': thing_name,
+        'pill_name': pill_name,
+        'pill_hour': hour,
+        'pill_minute': minute,
+        'color': color,
+        'buzzer_enabled': buzzer_enabled,
+        'user_id': user_id,
+        'event_type': 'schedule_update',
+        'reported': {}
+    })
+
+
 # ---------------- Dynamo/Device helper functions ----------------
+_device_cache = {}
+_device_cache_preloaded_at = 0.0
+
+
 def get_user_device(user_id):
-    """Query user_table for the device mapped to this user."""
+    """Query user_table for the device mapped to this user (cached per container)."""
+    cached = _device_cache.get(user_id)
+    if cached and time.time() - cached[1] < DEVICE_CACHE_TTL:
+        return cached[0]
     try:
-        resp = user_table.query(KeyConditionExpression=Key('user_id').eq(user_id))
-        items = resp.get('Items', [])
+        items = query_items(USER_TABLE, Key('user_id').eq(user_id))
         if not items:
             return None
+        _device_cache[user_id] = (items[0], time.time())
         return items[0]
     except Exception as e:
         print("get_user_device error:", e)
@@ -175,101 +376,151 @@ def get_user_device(user_id):
         return None
 
 
+def preload_device_mappings():
+    """
+    Fill the device cache from a scan of user_table bounded by
+    WARMUP_PRELOAD_LIMIT. While the last pre-load is fresh, a miss query
+    keeps the connection warm instead.
+    """
+    global _device_cache_preloaded_at
+    loaded_at = time.time()
+    if loaded_at - _device_cache_preloaded_at < DEVICE_CACHE_TTL:
+        query_items(USER_TABLE, Key('user_id').eq('warmup'))
+        return 0
+    mappings = {}
+    pages = ddb.get_paginator('scan').paginate(
+        TableName=USER_TABLE,
+        PaginationConfig={'MaxItems': WARMUP_PRELOAD_LIMIT}
+    )
+    for page in pages:
+        for raw in page.get('Items', []):
+            item = to_item(raw)
+            # First item per user matches what the query in get_user_device returns
+            mappings.setdefault(item['user_id'], item)
+    _device_cache.update((user_id, (item, loaded_at)) for user_id, item in mappings.items())
+    _device_cache_preloaded_at = loaded_at
+    return len(mappings)
+
+
+def prime_iot():
+    """Any data-plane call opens the IoT connection; a missing shadow is fine."""
+    thing_name = next((item.get('thing_name') for item, _ in _device_cache.values()), None)
+    iot.get_thing_shadow(thingName=thing_name or 'warmup')
+
+
+WARMUP_PRIMERS = {
+    'dynamodb': preload_device_mappings,
+    'iot-data': prime_iot,
+}
+
+
 # ---------------- IoT Rule Event Handlers ----------------
+def build_dispense_completed_item(event, timestamp_bz=None):
+    """
+    Build the dispense_completed item for an IoT dispense event, resolving
+    pill_name/user_id from the original request or the latest schedule.
+    timestamp_bz defaults to now; replays pass the archived event time.
+    """
+    thing_name = event.get('thing_name')
+    command_id = event.get('command_id')
+    dispensed_color = event.get('dispensed_color')
+    dispensed_angle = event.get('dispensed_angle')
+    dispense_status = event.get('dispense_status')
+    last_dispense = event.get('last_dispense')
+    
+    # Color sensor data
+    dominant_color = event.get('dominant_color')
+    r = event.get('r')
+    g = event.get('g')
+    b = event.get('b')
+
+    if timestamp_bz is None:
+        timestamp_bz = now_bz_epoch_seconds()
+
+    # Find the original dispense_request to get pill_name and user_id
+    pill_name = 'UNKNOWN'
+    user_id = 'SYSTEM'
+    
+    if command_id:
+        try:
+            items = query_items(EVENTS_TABLE, Key('command_id').eq(int(command_id)))
+            if items:
+                original_request = items[0]
+                pill_name = original_request.get('pill_name', 'UNKNOWN')
+                user_id = original_request.get('user_id', 'SYSTEM')
+                print(f"[handle_dispense_completed] Found original request: pill={pill_name}, user={user_id}")
+        except Exception as e:
+            print(f"[handle_dispense_completed] Error finding original request: {e}")
+    
+    # If we still don't have pill_name/user_id, try to get from most recent schedule
+    if pill_name == 'UNKNOWN' and dispensed_color:
+        try:
+            items = scan_items(
+                EVENTS_TABLE,
+                Attr('event_type').eq('schedule_update') & 
+                Attr('thing_name').eq(thing_name) &
+                Attr('color').eq(dispensed_color),
+                Limit=1
+            )
+            if items:
+                pill_name = items[0].get('pill_name', 'UNKNOWN')
+                user_id = items[0].get('user_id', 'SYSTEM')
+                print(f"[handle_dispense_completed] Inferred from schedule: pill={pill_name}, user={user_id}")
+        except Exception as e:
+            print(f"[handle_dispense_completed] Error inferring from schedule: {e}")
+
+    # Parse last_dispense safely
+    last_dispense_epoch = 0
+    if isinstance(last_dispense, str) and last_dispense:
+        try:
+            # Handle ISO format like "2025-12-09T13:55:00Z"
+            dt = datetime.fromisoformat(last_dispense.replace("Z", "+00:00"))
+            last_dispense_epoch = int(dt.timestamp())
+        except Exception:
+            last_dispense_epoch = 0
+    elif isinstance(last_dispense, (int, float)):
+        last_dispense_epoch = int(last_dispense)
+
+    item = {
+        'command_id': int(command_id) if command_id else int(time.time() * 1000),
+        'timestamp': timestamp_bz,
+        'thing_name': thing_name,
+        'pill_name': pill_name,
+        'color': dispensed_color or 'UNKNOWN',
+        'user_id': user_id,
+        'event_type': 'dispense_completed',
+        'reported': {
+            'dispensed_color': dispensed_color or 'UNKNOWN',
+            'dispensed_angle': int(dispensed_angle) if dispensed_angle is not None else 0,
+            'dispense_status': dispense_status or 'unknown',
+            'last_dispense': last_dispense_epoch,
+            'dominant_color': dominant_color or 'Unknown',
+            'r': int(r) if r is not None else 0,
+            'g': int(g) if g is not None else 0,
+            'b': int(b) if b is not None else 0
+        }
+    }
+    return with_retention(item)
+
+
 def handle_dispense_completed(event):
     """
     Handle completed dispense events from IoT Rule (esp32_dispense_data_collection).
     This is triggered when device reports dispense completion in shadow.
     """
     try:
-        print("[handle_dispense_completed] incoming:", json.dumps(event, default=str))
-        
-        thing_name = event.get('thing_name')
-        command_id = event.get('command_id')
-        dispensed_color = event.get('dispensed_color')
-        dispensed_angle = event.get('dispensed_angle')
-        dispense_status = event.get('dispense_status')
-        last_dispense = event.get('last_dispense')
-        
-        # Color sensor data
-        dominant_color = event.get('dominant_color')
-        r = event.get('r')
-        g = event.get('g')
-        b = event.get('b')
-
-        now_bz = datetime.now(BOLIVIA_TZ)
-        timestamp_bz = int(now_bz.timestamp())
-
-        # Find the original dispense_request to get pill_name and user_id
-        pill_name = 'UNKNOWN'
-        user_id = 'SYSTEM'
-        
-        if command_id:
-            try:
-                resp = events_table.query(
-                    KeyConditionExpression=Key('command_id').eq(int(command_id))
-                )
-                items = resp.get('Items', [])
-                if items:
-                    original_request = items[0]
-                    pill_name = original_request.get('pill_name', 'UNKNOWN')
-                    user_id = original_request.get('user_id', 'SYSTEM')
-                    print(f"[handle_dispense_completed] Found original request: pill={pill_name}, user={user_id}")
-            except Exception as e:
-                print(f"[handle_dispense_completed] Error finding original request: {e}")
-        
-        # If we still don't have pill_name/user_id, try to get from most recent schedule
-        if pill_name == 'UNKNOWN' and dispensed_color:
-            try:
-                resp = events_table.scan(
-                    FilterExpression=Attr('event_type').eq('schedule_update') & 
-                                   Attr('thing_name').eq(thing_name) &
-                                   Attr('color').eq(dispensed_color),
-                    Limit=1
-                )
-                items = resp.get('Items', [])
-                if items:
-                    pill_name = items[0].get('pill_name', 'UNKNOWN')
-                    user_id = items[0].get('user_id', 'SYSTEM')
-                    print(f"[handle_dispense_completed] Inferred from schedule: pill={pill_name}, user={user_id}")
-            except Exception as e:
-                print(f"[handle_dispense_completed] Error inferring from schedule: {e}")
-
-        # Parse last_dispense safely
-        last_dispense_epoch = 0
-        if isinstance(last_dispense, str) and last_dispense:
-            try:
-                # Handle ISO format like "2025-12-09T13:55:00Z"
-                dt = datetime.fromisoformat(last_dispense.replace("Z", "+00:00"))
-                last_dispense_epoch = int(dt.timestamp())
-            except Exception:
-                last_dispense_epoch = 0
-        elif isinstance(last_dispense, (int, float)):
-            last_dispense_epoch = int(last_dispense)
-
-        # Store dispense completion event
-        item = {
-            'command_id': int(command_id) if command_id else int(time.time() * 1000),
-            'timestamp': timestamp_bz,
-            'thing_name': thing_name,
-            'pill_name': pill_name,
-            'color': dispensed_color or 'UNKNOWN',
-            'user_id': user_id,
-            'event_type': 'dispense_completed',
-            'reported': {
-                'dispensed_color': dispensed_color or 'UNKNOWN',
-                'dispensed_angle': int(dispensed_angle) if dispensed_angle is not None else 0,
-                'dispense_status': dispense_status or 'unknown',
-                'last_dispense': last_dispense_epoch,
-                'dominant_color': dominant_color or 'Unknown',
-                'r': int(r) if r is not None else 0,
-                'g': int(g) if g is not None else 0,
-                'b': int(b) if b is not None else 0
-            }
-        }
-        
-        print("[handle_dispense_completed] Writing item to DynamoDB:", json.dumps(item, default=str))
-        events_table.put_item(Item=item)
+        item = build_dispense_completed_item(event)
+
+        print("[handle_dispense_completed] Writing item to DynamoDB:", encode_json(item))
+        put_event(item)
+        invalidate_user_cache(item['user_id'])
+
+        # Sensor health tracking must never fail the dispense log
+        try:
+            check_color_sensor(item)
+        except Exception as e:
+            print(f"[handle_dispense_completed] color stats error: {e}")
+            log_exception()
         
         return {'statusCode': 200, 'body': json.dumps('Dispense completion logged')}
         
@@ -279,43 +530,209 @@ def handle_dispense_completed(event):
         return {'statusCode': 500, 'body': json.dumps(str(e))}
 
 
+# ---------------- Color sensor health ----------------
+# The firmware reports dominant_color = dispensed_color today
+# (ShadowClient::publishDispenseReport), so the mismatch rate stays 0 until
+# the device classifies on its own; until then the drift check (windowed RGB
+# mean vs EXPECTED_COLOR_RGB) is what catches a degrading sensor.
+def _slot_names(slot):
+    """Attribute names of one ring slot in a stats item."""
+    p = f"s{slot}_"
+    return {k: p + k for k in ('e', 'n', 'm', 'r', 'g', 'b', 'rr', 'gg', 'bb')}
+
+
+def _stats_key(thing_name, color):
+    return from_item({'thing_name': thing_name, 'color': color})
+
+
+def update_color_stats(thing_name, color, mismatch, r, g, b, timestamp_bz):
+    """
+    Fold one dispense into the (thing, dispensed color) stats item and return it.
+
+    The item is a ring of STATS_SLOTS time slots, each holding count,
+    mismatch count and RGB sums/sums of squares. A slot is incremented with
+    ADD while its epoch matches; the first event of a new period resets it
+    with SET. Both are conditional single-item updates, so no history is read.
+    """
+    slot_epoch = timestamp_bz // STATS_SLOT_SECONDS
+    names = _slot_names(slot_epoch % STATS_SLOTS)
+    attr_names = {f"#{k}": v for k, v in names.items()}
+    values = {
+        ':e': slot_epoch, ':n': 1, ':m': 1 if mismatch else 0,
+        ':r': r, ':g': g, ':b': b, ':rr': r * r, ':gg': g * g, ':bb': b * b,
+    }
+    increment = {
+        'UpdateExpression': 'ADD ' + ', '.join(f"#{k} :{k}" for k in names if k != 'e'),
+        'ConditionExpression': '#e = :e',
+    }
+    reset = {
+        'UpdateExpression': 'SET ' + ', '.join(f"#{k} = :{k}" for k in names),
+        'ConditionExpression': 'attribute_not_exists(#e) OR #e < :e',
+    }
+    conditional_failed = ddb.exceptions.ConditionalCheckFailedException
+
+    # increment -> reset -> increment covers a concurrent reset of the same slot
+    for attempt in (increment, reset, increment):
+        try:
+            resp = ddb.update_item(
+                TableName=STATS_TABLE,
+                Key=_stats_key(thing_name, color),
+                ExpressionAttributeNames=attr_names,
+                ExpressionAttributeValues=from_item(values),
+                ReturnValues='ALL_NEW',
+                **attempt
+            )
+            return to_item(resp['Attributes'])
+        except conditional_failed:
+            continue
+
+    # Slot already holds a newer period: the event is older than the window
+    print(f"[update_color_stats] dropped late event for {thing_name} {color} at {timestamp_bz}")
+    return None
+
+
+def summarize_color_stats(stats, timestamp_bz):
+    """Aggregate the ring slots that fall inside the current window."""
+    current = timestamp_bz // STATS_SLOT_SECONDS
+    total = {k: 0 for k in ('n', 'm', 'r', 'g', 'b', 'rr', 'gg', 'bb')}
+    for slot in range(STATS_SLOTS):
+        names = _slot_names(slot)
+        epoch = stats.get(names['e'])
+        if epoch is None or current - epoch >= STATS_SLOTS:
+            continue
+        for k in total:
+            total[k] += stats.get(names[k], 0)
+
+    n = total['n']
+    if not n:
+        return {'samples': 0, 'mismatch_rate': 0.0}
+    summary = {'samples': n, 'mismatch_rate': total['m'] / n}
+    for c in ('r', 'g', 'b'):
+        mean = total[c] / n
+        summary[f'{c}_mean'] = round(mean, 2)
+        summary[f'{c}_var'] = round(max(total[c + c] / n - mean * mean, 0.0), 2)
+    return summary
+
+
+def color_drift(summary, color):
+    """Distance of the windowed RGB mean from the color's expected RGB, or None."""
+    expected = EXPECTED_COLOR_RGB.get(color)
+    if not expected or not summary['samples']:
+        return None
+    mean = (summary['r_mean'], summary['g_mean'], summary['b_mean'])
+    return round(sum((m - e) ** 2 for m, e in zip(mean, expected)) ** 0.5, 2)
+
+
+def check_color_sensor(item):
+    """
+    Update rolling stats for a dispense_completed item and alert when the
+    windowed mismatch rate is high or the RGB mean has drifted from the
+    expected values for the dispensed color.
+    """
+    reported = item['reported']
+    dispensed = reported['dispensed_color'].upper()
+    dominant = reported['dominant_color'].upper()
+    if dispensed == 'UNKNOWN' or dominant == 'UNKNOWN':
+        return
+    mismatch = dominant != dispensed
+    thing_name = item['thing_name']
+    timestamp_bz = item['timestamp']
+
+    stats = update_color_stats(
+        thing_name, dispensed, mismatch, reported['r'], reported['g'], reported['b'], timestamp_bz
+    )
+    if stats is None:
+        return
+    summary = summarize_color_stats(stats, timestamp_bz)
+    if summary['samples'] < COLOR_ALERT_MIN_SAMPLES:
+        return
+    drift = color_drift(summary, dispensed)
+    if summary['mismatch_rate'] >= MISMATCH_ALERT_RATE:
+        event_type = 'color_mismatch_alert'
+    elif drift is not None and drift >= DRIFT_ALERT_DISTANCE:
+        event_type = 'color_drift_alert'
+    else:
+        return
+
+    # One alert per (thing, color) and cooldown period, claimed atomically across invocations
+    try:
+        ddb.update_item(
+            TableName=STATS_TABLE,
+            Key=_stats_key(thing_name, dispensed),
+            UpdateExpression='SET last_alert_ts = :now',
+            ConditionExpression='attribute_not_exists(last_alert_ts) OR last_alert_ts < :cutoff',
+            ExpressionAttributeValues=from_item({
+                ':now': timestamp_bz, ':cutoff': timestamp_bz - COLOR_ALERT_COOLDOWN
+            })
+        )
+    except ddb.exceptions.ConditionalCheckFailedException:
+        return
+
+    report = {**summary, 'color': dispensed}
+    if drift is not None:
+        report.update(drift=drift, expected_rgb=EXPECTED_COLOR_RGB[dispensed])
+    alert = {
+        'thing_name': thing_name,
+        'event_type': event_type,
+        'window_seconds': STATS_SLOTS * STATS_SLOT_SECONDS,
+        **report
+    }
+    alert_json = encode_json(alert)
+    print("[check_color_sensor] ALERT:", alert_json)
+    iot.publish(topic=f"esp32/alerts/{thing_name}", qos=1, payload=alert_json)
+    put_event(with_retention({
+        'command_id': int(time.time() * 1000),
+        'timestamp': timestamp_bz,
+        'thing_name': thing_name,
+        'user_id': item.get('user_id', 'SYSTEM'),
+        'event_type': event_type,
+        'reported': report
+    }))
+
+
+def build_schedule_monitor_item(event, timestamp_bz=None, command_id=None):
+    """
+    Build the scheduled_time_monitor item for an IoT schedule report.
+    timestamp_bz/command_id default to now; replays pass values derived
+    from the archived event so re-runs overwrite instead of duplicating.
+    """
+    pill_hour = event.get('pill_hour')
+    pill_minute = event.get('pill_minute')
+    last_dispense = event.get('last_dispense', 0)
+    last_command_id = event.get('last_command_id', 0)
+
+    if timestamp_bz is None:
+        timestamp_bz = now_bz_epoch_seconds()
+    if command_id is None:
+        command_id = int(time.time() * 1000)
+
+    return with_retention({
+        'command_id': command_id,
+        'timestamp': timestamp_bz,
+        'thing_name': event.get('thing_name'),
+        'pill_name': event.get('pill_name', 'UNKNOWN'),
+        'pill_hour': int(pill_hour) if pill_hour is not None else -1,
+        'pill_minute': int(pill_minute) if pill_minute is not None else -1,
+        'user_id': 'SYSTEM',
+        'event_type': 'scheduled_time_monitor',
+        'reported': {
+            'buzzer_enabled': event.get('buzzer_enabled', False),
+            'last_dispense': int(last_dispense) if last_dispense else 0,
+            'reported_command_id': int(last_command_id) if last_command_id else 0
+        }
+    })
+
+
 def handle_schedule_monitor(event):
     """
     Handle scheduled time monitor events from IoT Rule (esp32_scheduled_time_monitor).
     This logs when device reports its current schedule configuration.
     """
     try:
-        print("[handle_schedule_monitor] incoming:", json.dumps(event, default=str))
+        item = build_schedule_monitor_item(event)
         
-        thing_name = event.get('thing_name')
-        pill_name = event.get('pill_name', 'UNKNOWN')
-        pill_hour = event.get('pill_hour')
-        pill_minute = event.get('pill_minute')
-        buzzer_enabled = event.get('buzzer_enabled', False)
-        last_dispense = event.get('last_dispense', 0)
-        last_command_id = event.get('last_command_id', 0)
-
-        now_bz = datetime.now(BOLIVIA_TZ)
-        timestamp_bz = int(now_bz.timestamp())
-
-        item = {
-            'command_id': int(time.time() * 1000),
-            'timestamp': timestamp_bz,
-            'thing_name': thing_name,
-            'pill_name': pill_name,
-            'pill_hour': int(pill_hour) if pill_hour is not None else -1,
-            'pill_minute': int(pill_minute) if pill_minute is not None else -1,
-            'user_id': 'SYSTEM',
-            'event_type': 'scheduled_time_monitor',
-            'reported': {
-                'buzzer_enabled': buzzer_enabled,
-                'last_dispense': int(last_dispense) if last_dispense else 0,
-                'reported_command_id': int(last_command_id) if last_command_id else 0
-            }
-        }
-        
-        print("[handle_schedule_monitor] Writing item to DynamoDB:", json.dumps(item, default=str))
-        events_table.put_item(Item=item)
+        print("[handle_schedule_monitor] Writing item to DynamoDB:", encode_json(item))
+        put_event(item)
         
         return {'statusCode': 200, 'body': json.dumps('Schedule monitor logged')}
         
@@ -335,13 +752,13 @@ def handle_dispense(user_id, thing_name, pill_name):
         print(f"[handle_dispense] Looking for pill '{pill_name}' for user {user_id}")
         
         # Find the scheduled color for this pill
-        resp = events_table.scan(
-            FilterExpression=Attr('user_id').eq(user_id) & 
-                           Attr('event_type').eq('schedule_update') &
-                           Attr('pill_name').eq(pill_name)
+        items = scan_items(
+            EVENTS_TABLE,
+            Attr('user_id').eq(user_id) & 
+            Attr('event_type').eq('schedule_update') &
+            Attr('pill_name').eq(pill_name)
         )
         
-        items = resp.get('Items', [])
         print(f"[handle_dispense] Found {len(items)} schedule_update items for {pill_name}")
         
         if not items:
@@ -351,7 +768,7 @@ def handle_dispense(user_id, thing_name, pill_name):
             )
 
         # Use the most recent schedule
-        latest = max(items, key=lambda x: int(x.get('timestamp', 0)))
+        latest = max(items, key=lambda x: x.get('timestamp', 0))
         pill_color = latest.get('color', 'UNKNOWN')
         
         print(f"[handle_dispense] Found color: {pill_color}")
@@ -367,17 +784,18 @@ def handle_dispense(user_id, thing_name, pill_name):
         
         # Publish to command topic (immediate action, not shadow)
         topic = f"esp32/commands/{thing_name}"
-        print(f"[handle_dispense] Publishing to topic {topic}: {command_payload}")
+        command_json = encode_json(command_payload)
+        print(f"[handle_dispense] Publishing to topic {topic}: {command_json}")
         
         iot.publish(
             topic=topic,
             qos=1,  # QoS 1 for at-least-once delivery
-            payload=json.dumps(command_payload)
+            payload=command_json
         )
 
         # Log dispense request in DynamoDB
         now_bz = datetime.now(BOLIVIA_TZ)
-        events_table.put_item(Item={
+        put_event(with_retention({
             'command_id': command_id,
             'timestamp': int(now_bz.timestamp()),
             'thing_name': thing_name,
@@ -386,7 +804,8 @@ def handle_dispense(user_id, thing_name, pill_name):
             'user_id': user_id,
             'event_type': 'dispense_request',
             'reported': {}
-        })
+        }))
+        invalidate_user_cache(user_id)
         
         print(f"[handle_dispense] Successfully logged dispense request")
 
@@ -505,24 +924,13 @@ def handle_alexa_event(event, context):
                 command_id = int(time.time() * 1000)
 
                 # Update shadow desired state for OTA configuration
-                shadow_payload = {
-                    "state": {
-                        "desired": {
-                            "pill_name": pill_name,
-                            "color": color,
-                            "pill_hour": hour,
-                            "pill_minute": minute,
-                            "buzzer_enabled": True,
-                            "command_id": command_id
-                        }
-                    }
-                }
+                shadow_payload = build_schedule_shadow_payload(pill_name, color, hour, minute, command_id)
                 
                 try:
                     print(f"[SetPillTimeIntent] Updating shadow for {thing_name}")
                     iot.update_thing_shadow(
                         thingName=thing_name, 
-                        payload=json.dumps(shadow_payload)
+                        payload=encode_json(shadow_payload)
                     )
                 except Exception as e:
                     print("update_thing_shadow error:", e)
@@ -533,20 +941,10 @@ def handle_alexa_event(event, context):
                     )
 
                 # Log schedule update
-                now_bz = datetime.now(BOLIVIA_TZ)
-                events_table.put_item(Item={
-                    'command_id': command_id,
-                    'timestamp': int(now_bz.timestamp()),
-                    'thing_name': thing_name,
-                    'pill_name': pill_name,
-                    'pill_hour': hour,
-                    'pill_minute': minute,
-                    'color': color,
-                    'buzzer_enabled': True,
-                    'user_id': user_id,
-                    'event_type': 'schedule_update',
-                    'reported': {}
-                })
+                put_event(build_schedule_update_item(
+                    command_id, thing_name, user_id, pill_name, color, hour, minute
+                ))
+                invalidate_user_cache(user_id)
 
                 time_12h = format_time_12h(hour, minute)
                 return build_response(
@@ -605,46 +1003,66 @@ def handle_alexa_event(event, context):
 
 
 # ---------------- Query Functions ----------------
+def load_schedule(user_id):
+    """Schedule entries (pill_name, color, pill_hour, pill_minute) for the user."""
+    items = scan_items(
+        EVENTS_TABLE,
+        Attr('user_id').eq(user_id) & 
+        Attr('event_type').eq('schedule_update'),
+        ConsistentRead=True
+    )
+    return [
+        {k: item.get(k) for k in ('pill_name', 'color', 'pill_hour', 'pill_minute')}
+        for item in items
+    ]
+
+
+def find_next_pill(schedule, now_bz):
+    """Schedule entry closest after now_bz, wrapping past midnight."""
+    current_minutes = now_bz.hour * 60 + now_bz.minute
+    
+    next_pill = None
+    min_diff = float('inf')
+
+    for item in schedule:
+        pill_minutes = (item.get('pill_hour') or 0) * 60 + (item.get('pill_minute') or 0)
+        
+        if pill_minutes >= current_minutes:
+            diff = pill_minutes - current_minutes
+        else:
+            diff = (24 * 60 - current_minutes) + pill_minutes
+
+        if diff < min_diff:
+            min_diff = diff
+            next_pill = item
+
+    return next_pill
+
+
 def get_next_pill(user_id):
     """Get the next scheduled pill for the user."""
     try:
-        resp = events_table.scan(
-            FilterExpression=Attr('user_id').eq(user_id) & 
-                           Attr('event_type').eq('schedule_update')
-        )
-        items = resp.get('Items', [])
+        # The schedule is cached; the answer depends on the clock, so it is
+        # recomputed from the schedule on every request
+        cache = read_user_cache(user_id)
+        entry = cached_entry(cache, 'GetCurrentPillIntent')
+        if entry:
+            schedule = entry['schedule']
+        else:
+            schedule = load_schedule(user_id)
+            store_cache_entry(user_id, 'GetCurrentPillIntent', cache, {'schedule': schedule})
         
-        if not items:
+        if not schedule:
             return build_response(
                 "No pills scheduled. Would you like to schedule one?", 
                 end_session=False
             )
 
-        now_bz = datetime.now(BOLIVIA_TZ)
-        current_minutes = now_bz.hour * 60 + now_bz.minute
-        
-        next_pill = None
-        min_diff = float('inf')
-
-        for item in items:
-            h = int(item.get('pill_hour', 0))
-            m = int(item.get('pill_minute', 0))
-            pill_minutes = h * 60 + m
-            
-            if pill_minutes >= current_minutes:
-                diff = pill_minutes - current_minutes
-            else:
-                diff = (24 * 60 - current_minutes) + pill_minutes
-
-            if diff < min_diff:
-                min_diff = diff
-                next_pill = item
+        next_pill = find_next_pill(schedule, datetime.now(BOLIVIA_TZ))
 
         if next_pill:
-            hour = int(next_pill['pill_hour'])
-            minute = int(next_pill['pill_minute'])
-            time_12h = format_time_12h(hour, minute)
-            color = next_pill.get('color', 'UNKNOWN').lower()
+            time_12h = format_time_12h(next_pill['pill_hour'], next_pill['pill_minute'])
+            color = (next_pill.get('color') or 'UNKNOWN').lower()
             
             return build_response(
                 f"Your next scheduled pill is {color} {next_pill['pill_name']} at {time_12h}.", 
@@ -662,47 +1080,50 @@ def get_next_pill(user_id):
         )
 
 
-def get_last_dispensed(user_id):
-    """Get the last dispensed pill for the user."""
-    try:
-        # Query for dispense_completed events (most accurate)
-        resp = events_table.scan(
-            FilterExpression=Attr('user_id').eq(user_id) & 
-                           Attr('event_type').eq('dispense_completed')
+def last_dispensed_text(user_id):
+    """Spoken answer for GetLastDispensedPillIntent, computed from the events table."""
+    # Query for dispense_completed events (most accurate)
+    items = scan_items(
+        EVENTS_TABLE,
+        Attr('user_id').eq(user_id) & 
+        Attr('event_type').eq('dispense_completed'),
+        ConsistentRead=True
+    )
+    
+    # Fallback to dispense_request if no completed dispenses
+    if not items:
+        items = scan_items(
+            EVENTS_TABLE,
+            Attr('user_id').eq(user_id) & 
+            Attr('event_type').eq('dispense_request'),
+            ConsistentRead=True
         )
+    
+    if items:
+        # Most recent by timestamp
+        last = max(items, key=lambda x: x.get('timestamp', 0))
         
-        items = resp.get('Items', [])
+        dt = datetime.fromtimestamp(last['timestamp'], tz=BOLIVIA_TZ)
+        time_12h = format_time_12h(dt.hour, dt.minute)
+        color = last.get('color', 'UNKNOWN').lower()
         
-        # Fallback to dispense_request if no completed dispenses
-        if not items:
-            resp = events_table.scan(
-                FilterExpression=Attr('user_id').eq(user_id) & 
-                               Attr('event_type').eq('dispense_request')
-            )
-            items = resp.get('Items', [])
+        return f"The last dispensed pill was {color} {last['pill_name']} at {time_12h}."
         
-        if items:
-            # Sort by timestamp descending
-            items_sorted = sorted(
-                items, 
-                key=lambda x: int(x.get('timestamp', 0)), 
-                reverse=True
-            )
-            last = items_sorted[0]
-            
-            dt = datetime.fromtimestamp(int(last['timestamp']), tz=BOLIVIA_TZ)
-            time_12h = format_time_12h(dt.hour, dt.minute)
-            color = last.get('color', 'UNKNOWN').lower()
-            
-            return build_response(
-                f"The last dispensed pill was {color} {last['pill_name']} at {time_12h}.", 
-                end_session=False
-            )
-            
-        return build_response(
-            "No pills have been dispensed yet.", 
-            end_session=False
-        )
+    return "No pills have been dispensed yet."
+
+
+def get_last_dispensed(user_id):
+    """Get the last dispensed pill for the user."""
+    try:
+        cache = read_user_cache(user_id)
+        entry = cached_entry(cache, 'GetLastDispensedPillIntent')
+        if entry:
+            text = entry['text']
+        else:
+            text = last_dispensed_text(user_id)
+            store_cache_entry(user_id, 'GetLastDispensedPillIntent', cache, {'text': text})
+
+        return build_response(text, end_session=False)
         
     except Exception as e:
         print("get_last_dispensed error:", e)
@@ -714,15 +1135,20 @@ def get_last_dispensed(user_id):
 
 
 # ---------------- Main Lambda Handler ----------------
+@profiled
 def lambda_handler(event, context):
     """
     Main entry point for Lambda.
     Handles:
     1. IoT Rule events (dispense completion, schedule monitoring)
     2. Alexa Skill requests
+    3. Keep-warm pings (lambdaWarmup)
     """
+    if is_warmup_event(event):
+        return handle_warmup(event, WARMUP_PRIMERS)
+
     print("=" * 80)
-    print("Received event:", json.dumps(event, default=str))
+    print("Received event:", encode_json(event))
     print("=" * 80)
     
     try:
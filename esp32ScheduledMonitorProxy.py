@@ -1,7 +1,20 @@
 import json
+import math
+import os
+import random
+import threading
+import time
+import uuid
 import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError, ConnectTimeoutError, EndpointConnectionError
 from datetime import datetime, timezone, timedelta
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional
+
+from archiveManifest import list_data_keys
+from archivePartitioning import discover_leaf_prefixes, object_key
+from invocationProfiler import profiled
+from lambdaWarmup import handle_warmup, is_warmup_event
 
 # ---------- CONFIG ----------
 MAIN_LAMBDA_NAME = "esp32ColorLambda"
@@ -12,10 +25,65 @@ S3_REGION = "us-east-2"
 
 BOLIVIA_TZ = timezone(timedelta(hours=-4))
 
+# Forwarding: the proxy owns retries (the client makes a single attempt).
+# Each attempt's read timeout is what is left of the budget after the connect
+# timeout, rounded down to FORWARD_TIMEOUT_STEP_SEC and capped at
+# FORWARD_TIMEOUT_SEC. A read timeout does not stop the main Lambda: it may
+# still finish the event, and the parked copy is then replayed and handled
+# twice (handle_dispense_completed keys rows on processing time, so a replay
+# writes a second row and can alert again). Keep FORWARD_TIMEOUT_SEC above
+# the main Lambda's own timeout and give the proxy a timeout that covers it.
+FORWARD_CONNECT_TIMEOUT_SEC = 1
+FORWARD_TIMEOUT_SEC = float(os.environ.get("FORWARD_TIMEOUT_SEC", "10"))
+FORWARD_TIMEOUT_STEP_SEC = 0.5    # bounds the number of per-timeout clients
+FORWARD_MAX_ATTEMPTS = 3
+FORWARD_BASE_DELAY_SEC = 0.1
+FORWARD_MAX_DELAY_SEC = 1.0
+FORWARD_SLOW_MS = 5000            # successful but slower than this counts against the breaker
+FORWARD_MIN_BUDGET_MS = int((FORWARD_CONNECT_TIMEOUT_SEC + FORWARD_TIMEOUT_STEP_SEC) * 1000)
+PARK_RESERVE_MS = 1000            # kept back from the Lambda deadline for parking
+DEFAULT_BUDGET_MS = 15000         # when there is no Lambda context (local runs)
+RETRYABLE_ERROR_CODES = {"TooManyRequestsException", "ServiceException", "EC2ThrottledException"}
+
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_OPEN_SEC = 30
+
+# Events that could not be forwarded wait here for a replay event
+PENDING_FORWARD_PREFIX = "pending_forward"
+REPLAY_FLAG = "_replay_pending"
+REPLAY_DEFAULT_LIMIT = 500
+REPLAY_MAX_TRIES = 5
+REPLAY_TRIES_METADATA = "replay-tries"
+DEAD_LETTER_PREFIX = "pending_forward_dead"
+
 # ---------- AWS CLIENTS ----------
-lambda_client = boto3.client("lambda", region_name=MAIN_LAMBDA_REGION)
+def make_lambda_client(read_timeout: float):
+    return boto3.client(
+        "lambda",
+        region_name=MAIN_LAMBDA_REGION,
+        config=Config(connect_timeout=FORWARD_CONNECT_TIMEOUT_SEC, read_timeout=read_timeout,
+                      retries={"total_max_attempts": 1, "mode": "standard"})
+    )
+
+
+lambda_client = make_lambda_client(FORWARD_TIMEOUT_SEC)
 s3_client = boto3.client("s3", region_name=S3_REGION)
 
+# Shorter-timeout clients for attempts late in the budget, created on first use
+_short_lambda_clients: Dict[float, Any] = {}
+_short_lambda_clients_lock = threading.Lock()
+
+
+def lambda_client_for(read_timeout: float):
+    """The Lambda client whose read timeout is `read_timeout` seconds."""
+    if read_timeout >= FORWARD_TIMEOUT_SEC:
+        return lambda_client
+    with _short_lambda_clients_lock:
+        client = _short_lambda_clients.get(read_timeout)
+        if client is None:
+            client = _short_lambda_clients[read_timeout] = make_lambda_client(read_timeout)
+        return client
+
 
 # ---------- HELPERS ----------
 def bolivia_timestamp() -> int:
@@ -37,54 +105,353 @@ def detect_event_type(event: Dict[str, Any]) -> str:
     return "device_state"
 
 
-def build_s3_key(event_type: str) -> str:
-    now = datetime.now(timezone.utc)
-    return (
-        f"{event_type}/"
-        f"year={now.year}/month={now.month:02d}/day={now.day:02d}/"
-        f"event_{int(now.timestamp() * 1000)}.json"
-    )
+def build_s3_key(event_type: str, event: Dict[str, Any]) -> str:
+    """Canonical UTC partition of the event time (receive time if the rule omitted it)."""
+    timestamp_ms = event.get("event_timestamp") or int(datetime.now(timezone.utc).timestamp() * 1000)
+    return object_key(event_type, int(timestamp_ms), event.get("thing_name"), source="proxy")
 
 
-def store_event_in_s3(event: Dict[str, Any]) -> None:
-    event_type = detect_event_type(event)
-    s3_key = build_s3_key(event_type)
+def store_event_in_s3(event: Dict[str, Any], body: str, s3_key: Optional[str] = None) -> str:
+    """Write the archive object; the compactor indexes it once its hour is sealed."""
+    s3_key = s3_key or build_s3_key(detect_event_type(event), event)
 
     s3_client.put_object(
         Bucket=S3_BUCKET,
         Key=s3_key,
-        Body=json.dumps(event),
+        Body=body,
         ContentType="application/json"
     )
+    return s3_key
+
+
+class MainLambdaError(Exception):
+    """The main Lambda failed the invocation (timeout, crash, out of memory)."""
 
 
-def forward_to_main_lambda(event: Dict[str, Any]) -> Dict[str, Any]:
-    response = lambda_client.invoke(
+def forward_to_main_lambda(payload: str, read_timeout: float = FORWARD_TIMEOUT_SEC) -> bytes:
+    """Invoke the main Lambda with an already-encoded event; returns the raw response."""
+    response = lambda_client_for(read_timeout).invoke(
         FunctionName=MAIN_LAMBDA_NAME,
         InvocationType="RequestResponse",
-        Payload=json.dumps(event)
+        Payload=payload
+    )
+
+    raw = response["Payload"].read()
+    if response.get("FunctionError"):
+        raise MainLambdaError(f"{response['FunctionError']}: {raw[:200]!r}")
+    return raw
+
+
+# ---------- CIRCUIT BREAKER ----------
+class CircuitBreaker:
+    """
+    Per-container breaker around the main-Lambda invoke.
+
+    closed     calls flow; `failure_threshold` consecutive failures open it
+    open       calls are refused until `open_sec` has passed
+    half_open  a single probe call goes through; success closes, failure re-opens
+    """
+
+    def __init__(self, failure_threshold: int, open_sec: float):
+        self.failure_threshold = failure_threshold
+        self.open_sec = open_sec
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                if time.monotonic() - self.opened_at < self.open_sec:
+                    return False
+                self.state = "half_open"
+                self.probing = False
+            if self.probing:
+                return False
+            self.probing = True
+            return True
+
+    def record_success(self) -> None:
+        with self.lock:
+            if self.state != "closed":
+                print(f"[breaker] {self.state} -> closed")
+            self.state = "closed"
+            self.failures = 0
+            self.probing = False
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                print(f"[breaker] {self.state} -> open after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class RetryBudget:
+    """
+    Adaptive retry throttle: failed attempts drain tokens, successes refill
+    them slowly, and retries are only allowed above half capacity. Under a
+    sustained outage retries stop before the breaker has even opened.
+    """
+
+    def __init__(self, max_tokens: float = 10.0, refill: float = 0.1):
+        self.max_tokens = max_tokens
+        self.refill = refill
+        self.tokens = max_tokens
+        self.lock = threading.Lock()
+
+    def record_success(self) -> None:
+        with self.lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.refill)
+
+    def record_failure(self) -> None:
+        with self.lock:
+            self.tokens = max(0.0, self.tokens - 1)
+
+    def can_retry(self) -> bool:
+        with self.lock:
+            return self.tokens > self.max_tokens / 2
+
+
+breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_OPEN_SEC)
+retry_budget = RetryBudget()
+
+# Replay probes the main Lambda on its own, so a failing backlog never sheds live events
+replay_breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_OPEN_SEC)
+replay_retry_budget = RetryBudget()
+
+
+def is_retryable(error: Exception) -> bool:
+    """Only errors where the main Lambda certainly did not run the event."""
+    if isinstance(error, (ConnectTimeoutError, EndpointConnectionError)):
+        return True
+    if isinstance(error, ClientError):
+        return error.response.get("Error", {}).get("Code") in RETRYABLE_ERROR_CODES
+    return False
+
+
+def deadline_for(context) -> float:
+    """Monotonic time by which forwarding must give up, leaving room to park."""
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        budget_ms = context.get_remaining_time_in_millis() - PARK_RESERVE_MS
+    else:
+        budget_ms = DEFAULT_BUDGET_MS
+    return time.monotonic() + budget_ms / 1000
+
+
+def remaining_ms(deadline: float) -> float:
+    return (deadline - time.monotonic()) * 1000
+
+
+def attempt_read_timeout(deadline: float) -> Optional[float]:
+    """Read timeout for an attempt started now, or None when no attempt fits."""
+    available = remaining_ms(deadline) / 1000 - FORWARD_CONNECT_TIMEOUT_SEC
+    steps = math.floor(available / FORWARD_TIMEOUT_STEP_SEC)
+    if steps < 1:
+        return None
+    return min(FORWARD_TIMEOUT_SEC, steps * FORWARD_TIMEOUT_STEP_SEC)
+
+
+def forward_with_breaker(payload: str,
+                         deadline: float,
+                         circuit: Optional[CircuitBreaker] = None,
+                         budget: Optional[RetryBudget] = None) -> Optional[bytes]:
+    """
+    Forward through the breaker with jittered retries inside the latency
+    budget, each attempt's read timeout sized to what is left of it. Returns
+    the raw response, or None when the event should be parked. Live traffic
+    uses the module breaker and retry budget unless others are given.
+    """
+    circuit = circuit or breaker
+    budget = budget or retry_budget
+    attempt = 0
+    while True:
+        read_timeout = attempt_read_timeout(deadline)
+        if read_timeout is None:
+            if attempt == 0:
+                print(f"[forward] ERROR: {remaining_ms(deadline):.0f} ms left, no attempt fits "
+                      f"(needs {FORWARD_MIN_BUDGET_MS} ms plus {PARK_RESERVE_MS} ms to park); "
+                      f"raise the proxy's timeout")
+            else:
+                print("[forward] latency budget exhausted")
+            return None
+        if not circuit.allow():
+            print(f"[forward] breaker {circuit.state}, shedding")
+            return None
+
+        attempt += 1
+        started = time.monotonic()
+        try:
+            raw = forward_to_main_lambda(payload, read_timeout)
+        except Exception as e:
+            circuit.record_failure()
+            budget.record_failure()
+            print(f"[forward] attempt {attempt} failed: {e}")
+            if not is_retryable(e) or attempt >= FORWARD_MAX_ATTEMPTS or not budget.can_retry():
+                return None
+            delay = random.uniform(0, min(FORWARD_MAX_DELAY_SEC, FORWARD_BASE_DELAY_SEC * (2 ** (attempt - 1))))
+            if remaining_ms(deadline) - delay * 1000 < FORWARD_MIN_BUDGET_MS:
+                return None
+            time.sleep(delay)
+            continue
+
+        elapsed_ms = (time.monotonic() - started) * 1000
+        if elapsed_ms > FORWARD_SLOW_MS:
+            print(f"[forward] slow response ({elapsed_ms:.0f} ms)")
+            circuit.record_failure()
+        else:
+            circuit.record_success()
+        budget.record_success()
+        return raw
+
+
+# ---------- PENDING FORWARDS ----------
+def park_event(event: Dict[str, Any], body: str) -> str:
+    """
+    Keep an unforwarded event under the pending_forward prefix for replay.
+    Parked events are partitioned by parking time, so replay takes them in
+    the order they were parked however old the event itself is.
+    """
+    parked_ms = int(datetime.now(timezone.utc).timestamp() * 1000)
+    # Parking time is not unique per event, so the name carries a random suffix
+    source = f"proxy-{uuid.uuid4().hex[:8]}"
+    s3_key = object_key(PENDING_FORWARD_PREFIX, parked_ms, event.get("thing_name"), source=source)
+    store_event_in_s3(event, body, s3_key)
+    return s3_key
+
+
+def pending_keys():
+    """Every parked event key, oldest partition first."""
+    for leaf in sorted(discover_leaf_prefixes(s3_client, S3_BUCKET, f"{PENDING_FORWARD_PREFIX}/")):
+        yield from sorted(list_data_keys(s3_client, S3_BUCKET, leaf))
+
+
+def record_failed_replay(key: str, body: str, tries: int) -> bool:
+    """
+    Store the try count on a parked event, or move it to the dead-letter
+    prefix once it has failed REPLAY_MAX_TRIES times. Returns True when moved.
+    """
+    if tries < REPLAY_MAX_TRIES:
+        s3_client.copy_object(
+            Bucket=S3_BUCKET,
+            Key=key,
+            CopySource={"Bucket": S3_BUCKET, "Key": key},
+            Metadata={REPLAY_TRIES_METADATA: str(tries)},
+            MetadataDirective="REPLACE",
+            ContentType="application/json"
+        )
+        return False
+
+    dead_key = DEAD_LETTER_PREFIX + key[len(PENDING_FORWARD_PREFIX):]
+    s3_client.put_object(
+        Bucket=S3_BUCKET,
+        Key=dead_key,
+        Body=body,
+        ContentType="application/json",
+        Metadata={REPLAY_TRIES_METADATA: str(tries)}
     )
+    s3_client.delete_object(Bucket=S3_BUCKET, Key=key)
+    print(f"[replay] {key} failed {tries} times, moved to {dead_key}")
+    return True
+
+
+def replay_pending(options: Dict[str, Any], deadline: float) -> Dict[str, Any]:
+    """
+    Forward every parked event oldest first, deleting each one once the main
+    Lambda has taken it. Replay has its own breaker and retry budget, so its
+    failures never shed live traffic.
+
+    A failed event is skipped, and its try is counted once the run shows the
+    main Lambda is otherwise healthy (a later forward succeeds, or the run ends
+    with the replay breaker closed); failures that end in the breaker opening
+    are an outage and are not counted. After REPLAY_MAX_TRIES an event moves
+    to the dead-letter prefix. Stops at `limit` events, at the end of the
+    latency budget, or when the replay breaker opens.
+    """
+    limit = int(options.get("limit", REPLAY_DEFAULT_LIMIT))
+    stats = {"forwarded": 0, "failed": 0, "dead_lettered": 0, "stopped": None}
+    suspects: List[tuple] = []
+
+    def settle():
+        for key, body, tries in suspects:
+            if record_failed_replay(key, body, tries):
+                stats["dead_lettered"] += 1
+        suspects.clear()
+
+    for key in pending_keys():
+        if stats["forwarded"] + stats["failed"] >= limit:
+            stats["stopped"] = "limit"
+            break
+        if attempt_read_timeout(deadline) is None:
+            stats["stopped"] = "latency budget"
+            break
+        obj = s3_client.get_object(Bucket=S3_BUCKET, Key=key)
+        body = obj["Body"].read().decode("utf-8")
+        tries = int(obj.get("Metadata", {}).get(REPLAY_TRIES_METADATA, "0")) + 1
+        if forward_with_breaker(body, deadline, replay_breaker, replay_retry_budget) is None:
+            if replay_breaker.state == "open":
+                stats["stopped"] = f"replay breaker open at {key}"
+                break
+            suspects.append((key, body, tries))
+            stats["failed"] += 1
+            continue
+        s3_client.delete_object(Bucket=S3_BUCKET, Key=key)
+        stats["forwarded"] += 1
+        settle()
+
+    if replay_breaker.state != "open":
+        settle()
+    return stats
 
-    payload = response["Payload"].read()
-    return json.loads(payload) if payload else {}
+
+def warmup_primers(event: Dict[str, Any]) -> Dict[str, Any]:
+    """Open the S3 connection and pass the ping on to the main Lambda."""
+    return {
+        "s3": lambda: s3_client.head_bucket(Bucket=S3_BUCKET),
+        "lambda": lambda: forward_to_main_lambda(json.dumps(event)),
+    }
 
 
 # ---------- HANDLER ----------
+@profiled
 def lambda_handler(event, context):
-    print("Proxy received event:", json.dumps(event))
+    # Keep-warm pings are neither archived nor treated as device events
+    if is_warmup_event(event):
+        return handle_warmup(event, warmup_primers(event))
 
     try:
+        # Scheduled replay of events parked while the main Lambda was unavailable
+        if REPLAY_FLAG in event:
+            options = event[REPLAY_FLAG] if isinstance(event[REPLAY_FLAG], dict) else {}
+            stats = replay_pending(options, deadline_for(context))
+            print("Pending replay:", json.dumps(stats))
+            return {"statusCode": 200, **stats}
+
         # Add proxy metadata (non-invasive)
         event["_proxy_received_bz"] = bolivia_timestamp()
 
+        # Encode once; the log line, the S3 object and the invoke payload share it
+        payload = json.dumps(event)
+        print("Proxy received event:", payload)
+
         # Store raw event for analytics (S3 / Athena / QuickSight)
-        store_event_in_s3(event)
+        store_event_in_s3(event, payload)
 
         # Forward event to main Lambda (business logic)
-        response_payload = forward_to_main_lambda(event)
+        raw_response = forward_with_breaker(payload, deadline_for(context))
+        if raw_response is None:
+            parked_key = park_event(event, payload)
+            print("Main Lambda unavailable, parked event:", parked_key)
+            return {"statusCode": 202, "parked": parked_key}
 
-        print("Main Lambda response:", json.dumps(response_payload))
-        return response_payload
+        print("Main Lambda response:", raw_response.decode("utf-8") if raw_response else "{}")
+        return json.loads(raw_response) if raw_response else {}
 
     except Exception as e:
         print("Proxy error:", str(e))
@@ -95,4 +462,3 @@ def lambda_handler(event, context):
             "statusCode": 500,
             "error": str(e)
         }
-
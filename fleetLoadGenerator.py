@@ -0,0 +1,438 @@
+"""
+Synthetic device-fleet load for the ingest path.
+
+Simulates N dispensers publishing the events the IoT rules deliver to
+esp32ScheduledMonitorProxy (dispense reports, schedule monitor reports and
+device state) as Poisson streams at per-device hourly rates, plus optional
+reconnect storms in which a fraction of the fleet re-publishes its state
+and schedule within a short window. Every event runs through the real
+proxy lambda_handler with its S3 and Lambda clients replaced by in-process
+stand-ins with configurable latency, main-Lambda concurrency limit and
+error rate, so archiving, forwarding, retries, the circuit breaker and
+parking all execute.
+
+Latency is measured from each event's scheduled arrival, so time spent
+queued behind a saturated proxy concurrency shows up in the tail instead
+of being hidden (no coordinated omission). The process shares a single
+breaker between simulated proxy containers, where production has one per
+container. The IoT*ToS3 archivers are not driven, so the S3 request load
+they add to the same partitions in production is not simulated; the
+report says so under "not_simulated".
+
+Usage:
+    python fleetLoadGenerator.py --devices 2000 --duration 60
+    python fleetLoadGenerator.py --devices 5000 --duration 30 --storm 10:1.0:2000 \\
+        --main-concurrency 50 --main-latency-ms 120
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from botocore.exceptions import ClientError, ReadTimeoutError
+
+import esp32ScheduledMonitorProxy as proxy
+from esp32ColorLambda import DISPENSE_ANGLES
+
+# ---------- CONFIG ----------
+DEFAULT_DEVICES = 500
+DEFAULT_DURATION_SEC = 30
+DEFAULT_CONCURRENCY = 64               # simulated proxy containers
+DEFAULT_DISPENSE_PER_HOUR = 2.0        # per device, scaled up for rehearsal
+DEFAULT_MONITOR_PER_HOUR = 60.0
+DEFAULT_STATE_PER_HOUR = 30.0
+
+BOLIVIA_OFFSET_SEC = -4 * 3600
+
+# Nominal sensor readings per color; reports add noise around them
+NOMINAL_RGB = {
+    "WHITE": (240, 240, 235), "CREAM": (235, 220, 180), "BROWN": (120, 80, 50),
+    "RED": (200, 40, 40), "BLUE": (40, 60, 200), "GREEN": (50, 170, 70), "OTHER": (128, 128, 128),
+}
+
+
+# ---------- LOCAL STAND-INS ----------
+class Latency:
+    """Base latency plus an exponential tail, in milliseconds."""
+
+    def __init__(self, base_ms: float, tail_ms: float = 0.0):
+        self.base_ms = base_ms
+        self.tail_ms = tail_ms
+
+    def sample_ms(self) -> float:
+        return self.base_ms + (random.expovariate(1 / self.tail_ms) if self.tail_ms > 0 else 0.0)
+
+    def wait(self) -> None:
+        delay = self.sample_ms()
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+
+def client_error(code: str, operation: str) -> ClientError:
+    return ClientError({"Error": {"Code": code, "Message": code}}, operation)
+
+
+class LocalS3:
+    """In-memory bucket with the calls the proxy and archiveManifest make, including conditional puts."""
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.objects: Dict[str, Tuple[bytes, str]] = {}
+        self.calls: Counter = Counter()
+        self.lock = threading.Lock()
+
+    def put_object(self, Bucket, Key, Body, ContentType=None, IfMatch=None, IfNoneMatch=None, **_):
+        self.latency.wait()
+        body = Body.encode("utf-8") if isinstance(Body, str) else Body
+        etag = f'"{hashlib.md5(body).hexdigest()}"'
+        with self.lock:
+            self.calls["put_object"] += 1
+            current = self.objects.get(Key)
+            if (IfNoneMatch == "*" and current is not None) or \
+                    (IfMatch is not None and (current is None or current[1] != IfMatch)):
+                self.calls["precondition_failed"] += 1
+                raise client_error("PreconditionFailed", "PutObject")
+            self.objects[Key] = (body, etag)
+        return {"ETag": etag}
+
+    def get_object(self, Bucket, Key, **_):
+        self.latency.wait()
+        with self.lock:
+            self.calls["get_object"] += 1
+            found = self.objects.get(Key)
+        if found is None:
+            raise client_error("NoSuchKey", "GetObject")
+        return {"Body": io.BytesIO(found[0]), "ETag": found[1]}
+
+    def delete_object(self, Bucket, Key, **_):
+        self.latency.wait()
+        with self.lock:
+            self.calls["delete_object"] += 1
+            self.objects.pop(Key, None)
+        return {}
+
+    def head_bucket(self, Bucket, **_):
+        self.latency.wait()
+        return {}
+
+    def get_paginator(self, name: str):
+        return _LocalListPaginator(self)
+
+
+class _LocalListPaginator:
+    def __init__(self, s3: LocalS3):
+        self.s3 = s3
+
+    def paginate(self, Bucket, Prefix="", Delimiter=None, **_):
+        self.s3.latency.wait()
+        with self.s3.lock:
+            self.s3.calls["list_objects_v2"] += 1
+            keys = sorted(k for k in self.s3.objects if k.startswith(Prefix))
+        contents, prefixes = [], set()
+        for key in keys:
+            rest = key[len(Prefix):]
+            if Delimiter and Delimiter in rest:
+                prefixes.add(Prefix + rest.split(Delimiter, 1)[0] + Delimiter)
+            else:
+                contents.append({"Key": key})
+        yield {"Contents": contents, "CommonPrefixes": [{"Prefix": p} for p in sorted(prefixes)]}
+
+
+class LocalLambda:
+    """
+    Main-Lambda stand-in: a reserved-concurrency limit (invokes beyond it are
+    throttled), a latency distribution (calls past the proxy's read timeout
+    time out) and a function error rate.
+    """
+
+    def __init__(self, latency: Latency, concurrency: int, error_rate: float, timeout_sec: float):
+        self.latency = latency
+        self.concurrency = concurrency
+        self.error_rate = error_rate
+        self.timeout_sec = timeout_sec
+        self.in_flight = 0
+        self.calls: Counter = Counter()
+        self.lock = threading.Lock()
+
+    def client_for(self, read_timeout: float) -> "LocalLambdaClient":
+        """Stands in for proxy.lambda_client_for: a client with its own read timeout."""
+        return LocalLambdaClient(self, read_timeout)
+
+    def invoke(self, FunctionName, InvocationType, Payload, _read_timeout=None, **_):
+        timeout_sec = self.timeout_sec if _read_timeout is None else _read_timeout
+        with self.lock:
+            self.calls["invoke"] += 1
+            if self.in_flight >= self.concurrency:
+                self.calls["throttled"] += 1
+                raise client_error("TooManyRequestsException", "Invoke")
+            self.in_flight += 1
+        try:
+            delay_ms = self.latency.sample_ms()
+            if delay_ms / 1000 > timeout_sec:
+                time.sleep(timeout_sec)
+                self.calls["timed_out"] += 1
+                raise ReadTimeoutError(endpoint_url=f"local://{FunctionName}")
+            time.sleep(delay_ms / 1000)
+            if random.random() < self.error_rate:
+                self.calls["function_error"] += 1
+                return {"StatusCode": 200, "FunctionError": "Unhandled",
+                        "Payload": io.BytesIO(b'{"errorMessage": "simulated failure"}')}
+            return {"StatusCode": 200, "Payload": io.BytesIO(b'{"statusCode": 200, "body": "\\"ok\\""}')}
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+class LocalLambdaClient:
+    """One read-timeout view of a LocalLambda, like the proxy's per-timeout clients."""
+
+    def __init__(self, target: LocalLambda, read_timeout: float):
+        self.target = target
+        self.read_timeout = read_timeout
+
+    def invoke(self, **kwargs):
+        return self.target.invoke(_read_timeout=self.read_timeout, **kwargs)
+
+
+# ---------- FLEET ----------
+class Device:
+    """One simulated dispenser with a fixed pill color and schedule."""
+
+    def __init__(self, index: int, rng: random.Random):
+        self.thing_name = f"esp32-load-{index:05d}"
+        self.color = rng.choice(sorted(DISPENSE_ANGLES))
+        self.pill_hour = rng.randrange(24)
+        self.pill_minute = rng.choice((0, 15, 30, 45))
+        self.command_id = rng.randrange(10 ** 12, 10 ** 13)
+        self.last_dispense = 0
+
+    def dispense_completed(self, now_ms: int, rng: random.Random) -> Dict[str, Any]:
+        self.command_id += 1
+        self.last_dispense = now_ms // 1000 + BOLIVIA_OFFSET_SEC
+        r, g, b = (max(0, min(255, int(rng.gauss(c, 12)))) for c in NOMINAL_RGB[self.color])
+        return {
+            "thing_name": self.thing_name,
+            "event_timestamp": now_ms,
+            "r": r, "g": g, "b": b,
+            "dominant_color": self.color,
+            "dispensed_color": self.color,
+            "dispensed_angle": DISPENSE_ANGLES[self.color],
+            "dispense_status": "OK",
+            "command_id": self.command_id,
+            "last_dispense": self.last_dispense,
+        }
+
+    def scheduled_time_monitor(self, now_ms: int) -> Dict[str, Any]:
+        return {
+            "thing_name": self.thing_name,
+            "event_timestamp": now_ms,
+            "pill_hour": self.pill_hour,
+            "pill_minute": self.pill_minute,
+            "buzzer_enabled": True,
+            "last_dispense": self.last_dispense,
+            "last_command_id": self.command_id,
+            "updated_at": now_ms // 1000 + BOLIVIA_OFFSET_SEC,
+        }
+
+    def device_state(self, now_ms: int) -> Dict[str, Any]:
+        return {
+            "thing_name": self.thing_name,
+            "event_timestamp": now_ms,
+            "reported_state": {
+                "pill_hour": self.pill_hour,
+                "pill_minute": self.pill_minute,
+                "buzzer_enabled": True,
+                "updated_at": now_ms // 1000 + BOLIVIA_OFFSET_SEC,
+            },
+        }
+
+
+def parse_storm(value: str) -> Tuple[float, float, float]:
+    """AT_SEC:FRACTION:WINDOW_MS, e.g. 10:0.8:2000."""
+    at, fraction, window = value.split(":")
+    return float(at), float(fraction), float(window)
+
+
+def build_arrivals(n_devices: int,
+                   duration: float,
+                   rates_per_hour: Dict[str, float],
+                   storms: List[Tuple[float, float, float]],
+                   seed: int) -> List[Tuple[float, int, str]]:
+    """Sorted (offset_sec, device index, event type) for the whole run."""
+    rng = random.Random(seed)
+    arrivals = []
+    for event_type, per_hour in rates_per_hour.items():
+        fleet_rate = n_devices * per_hour / 3600
+        if fleet_rate <= 0:
+            continue
+        t = rng.expovariate(fleet_rate)
+        while t < duration:
+            arrivals.append((t, rng.randrange(n_devices), event_type))
+            t += rng.expovariate(fleet_rate)
+    for at, fraction, window_ms in storms:
+        # A reconnecting device re-publishes its state and its schedule
+        for index in rng.sample(range(n_devices), int(n_devices * min(1.0, fraction))):
+            t = at + rng.uniform(0, window_ms / 1000)
+            arrivals.append((t, index, "device_state"))
+            arrivals.append((t + rng.uniform(0, 0.05), index, "scheduled_time_monitor"))
+    arrivals.sort()
+    return arrivals
+
+
+# ---------- REPORTING ----------
+def percentile(sorted_values: List[float], q: float) -> Optional[float]:
+    """Nearest-rank percentile of an ascending list."""
+    if not sorted_values:
+        return None
+    rank = max(1, int(round(q / 100 * len(sorted_values) + 0.5)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def latency_summary(values: List[float]) -> Dict[str, Optional[float]]:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "p50": _round(percentile(values, 50)),
+        "p95": _round(percentile(values, 95)),
+        "p99": _round(percentile(values, 99)),
+        "max": _round(values[-1] if values else None),
+    }
+
+
+def _round(value: Optional[float]) -> Optional[float]:
+    return round(value, 1) if value is not None else None
+
+
+# ---------- RUN ----------
+def run(n_devices: int,
+        duration: float,
+        rates_per_hour: Dict[str, float],
+        storms: List[Tuple[float, float, float]],
+        concurrency: int,
+        s3: LocalS3,
+        main_lambda: LocalLambda,
+        seed: int = 1,
+        verbose: bool = False) -> Dict[str, Any]:
+    rng = random.Random(seed)
+    devices = [Device(i, rng) for i in range(n_devices)]
+    arrivals = build_arrivals(n_devices, duration, rates_per_hour, storms, seed)
+    saved_clients = proxy.s3_client, proxy.lambda_client, proxy.lambda_client_for
+    proxy.s3_client, proxy.lambda_client, proxy.lambda_client_for = s3, main_lambda, main_lambda.client_for
+
+    results: List[Dict[str, Any]] = []
+    results_lock = threading.Lock()
+
+    def handle(scheduled_at: float, event: Dict[str, Any], event_type: str) -> None:
+        started = time.perf_counter()
+        status = "exception"
+        try:
+            response = proxy.lambda_handler(event, None)
+            status = str(response.get("statusCode", "none")) if isinstance(response, dict) else "none"
+        finally:
+            done = time.perf_counter()
+            with results_lock:
+                results.append({
+                    "type": event_type,
+                    "status": status,
+                    "service_ms": (done - started) * 1000,
+                    "end_to_end_ms": (done - scheduled_at) * 1000,
+                })
+
+    try:
+        with contextlib.ExitStack() as stack:
+            if not verbose:
+                devnull = stack.enter_context(open(os.devnull, "w"))
+                stack.enter_context(contextlib.redirect_stdout(devnull))
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+                for offset, index, event_type in arrivals:
+                    scheduled_at = start + offset
+                    delay = scheduled_at - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+                    device = devices[index]
+                    now_ms = int(time.time() * 1000)
+                    if event_type == "dispense_completed":
+                        event = device.dispense_completed(now_ms, rng)
+                    elif event_type == "scheduled_time_monitor":
+                        event = device.scheduled_time_monitor(now_ms)
+                    else:
+                        event = device.device_state(now_ms)
+                    pool.submit(handle, scheduled_at, event, event_type)
+            elapsed = time.perf_counter() - start
+    finally:
+        proxy.s3_client, proxy.lambda_client, proxy.lambda_client_for = saved_clients
+
+    by_type = {}
+    for event_type in sorted({r["type"] for r in results}):
+        mine = [r for r in results if r["type"] == event_type]
+        by_type[event_type] = {
+            "end_to_end_ms": latency_summary([r["end_to_end_ms"] for r in mine]),
+            "status": dict(Counter(r["status"] for r in mine)),
+        }
+    return {
+        "devices": n_devices,
+        "events": len(results),
+        "elapsed_sec": round(elapsed, 2),
+        "throughput_eps": round(len(results) / elapsed, 1) if elapsed else None,
+        "status": dict(Counter(r["status"] for r in results)),
+        "end_to_end_ms": latency_summary([r["end_to_end_ms"] for r in results]),
+        "service_ms": latency_summary([r["service_ms"] for r in results]),
+        "by_type": by_type,
+        "main_lambda": dict(main_lambda.calls),
+        "s3": dict(s3.calls),
+        "breaker": proxy.breaker.state,
+        "not_simulated": ["IoT*ToS3 archivers (their PUTs share the proxy's S3 partitions in production)"],
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Drive the ingest proxy with a simulated dispenser fleet.")
+    ap.add_argument("--devices", type=int, default=DEFAULT_DEVICES)
+    ap.add_argument("--duration", type=float, default=DEFAULT_DURATION_SEC, help="seconds of arrivals")
+    ap.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="simulated proxy containers")
+    ap.add_argument("--dispense-per-hour", type=float, default=DEFAULT_DISPENSE_PER_HOUR)
+    ap.add_argument("--monitor-per-hour", type=float, default=DEFAULT_MONITOR_PER_HOUR)
+    ap.add_argument("--state-per-hour", type=float, default=DEFAULT_STATE_PER_HOUR)
+    ap.add_argument("--storm", action="append", type=parse_storm, default=[],
+                    help="reconnect storm AT_SEC:FRACTION:WINDOW_MS (repeatable)")
+    ap.add_argument("--s3-latency-ms", type=float, default=15.0)
+    ap.add_argument("--s3-tail-ms", type=float, default=10.0)
+    ap.add_argument("--main-latency-ms", type=float, default=80.0)
+    ap.add_argument("--main-tail-ms", type=float, default=40.0)
+    ap.add_argument("--main-concurrency", type=int, default=100, help="main Lambda reserved concurrency")
+    ap.add_argument("--main-error-rate", type=float, default=0.0)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--verbose", action="store_true", help="keep the proxy's own log lines")
+    args = ap.parse_args(argv)
+
+    report = run(
+        args.devices,
+        args.duration,
+        {
+            "dispense_completed": args.dispense_per_hour,
+            "scheduled_time_monitor": args.monitor_per_hour,
+            "device_state": args.state_per_hour,
+        },
+        args.storm,
+        args.concurrency,
+        LocalS3(Latency(args.s3_latency_ms, args.s3_tail_ms)),
+        LocalLambda(Latency(args.main_latency_ms, args.main_tail_ms), args.main_concurrency,
+                    args.main_error_rate, proxy.FORWARD_TIMEOUT_SEC),
+        seed=args.seed,
+        verbose=args.verbose,
+    )
+    print(json.dumps(report, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
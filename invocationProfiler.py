@@ -0,0 +1,127 @@
+"""
+Opt-in profiling for Lambda handlers.
+
+    from invocationProfiler import profiled
+
+    @profiled
+    def lambda_handler(event, context):
+        ...
+
+An invocation is profiled when the event carries `"_profile": true` or when
+it falls in the PROFILE_SAMPLE_RATE fraction (0 disables sampling). A
+profiled invocation runs under cProfile and tracemalloc and logs the top
+PROFILE_TOP_N functions by cumulative time and allocation sites by size.
+With PROFILE_DUMP_PATH set (a local directory or s3://bucket/prefix), the
+full pstats file is written there as <handler>-<request id>.prof.
+
+Unprofiled invocations pay one flag lookup and, when sampling is enabled,
+one random draw.
+"""
+import cProfile
+import functools
+import io
+import os
+import pstats
+import random
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", "20"))
+PROFILE_TRACE_FRAMES = int(os.environ.get("PROFILE_TRACE_FRAMES", "5"))
+PROFILE_DUMP_PATH = os.environ.get("PROFILE_DUMP_PATH", "")
+PROFILE_EVENT_FLAG = "_profile"
+
+_s3_client = None
+
+
+def should_profile(event: Any) -> bool:
+    if isinstance(event, dict) and event.get(PROFILE_EVENT_FLAG):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def stats_summary(profiler: cProfile.Profile, top_n: int = PROFILE_TOP_N) -> str:
+    """Top-N functions by cumulative time, without the pstats banner."""
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs().sort_stats("cumulative").print_stats(top_n)
+    lines = out.getvalue().splitlines()
+    start = next((i for i, line in enumerate(lines) if line.lstrip().startswith("ncalls")), 0)
+    return "\n".join(line for line in lines[start:] if line.strip())
+
+
+def allocation_summary(snapshot: tracemalloc.Snapshot, top_n: int = PROFILE_TOP_N) -> str:
+    """Top-N allocation sites still live at the end of the invocation."""
+    stats = snapshot.statistics("lineno")[:top_n]
+    return "\n".join(
+        f"{s.size / 1024:9.1f} KiB {s.count:7d} blocks  {s.traceback[0].filename.rsplit('/', 1)[-1]}:"
+        f"{s.traceback[0].lineno}"
+        for s in stats
+    )
+
+
+def dump_stats(profiler: cProfile.Profile, name: str, dump_path: str = PROFILE_DUMP_PATH) -> Optional[str]:
+    """Write the full pstats file to a local directory or an s3:// prefix."""
+    global _s3_client
+    if not dump_path:
+        return None
+    filename = f"{name}.prof"
+    if not dump_path.startswith("s3://"):
+        os.makedirs(dump_path, exist_ok=True)
+        path = os.path.join(dump_path, filename)
+        profiler.dump_stats(path)
+        return path
+
+    bucket, _, prefix = dump_path[len("s3://"):].partition("/")
+    key = f"{prefix.rstrip('/')}/{filename}" if prefix else filename
+    local = os.path.join("/tmp", filename)
+    profiler.dump_stats(local)
+    if _s3_client is None:
+        import boto3
+        _s3_client = boto3.client("s3")
+    try:
+        _s3_client.upload_file(local, bucket, key)
+    finally:
+        os.remove(local)
+    return f"s3://{bucket}/{key}"
+
+
+def profiled(handler: Callable[[Any, Any], Any]) -> Callable[[Any, Any], Any]:
+    """Wrap a Lambda handler so sampled or flagged invocations are profiled."""
+
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        if not should_profile(event):
+            return handler(event, context)
+
+        request_id = getattr(context, "aws_request_id", None) or str(int(time.time() * 1000))
+        name = f"{handler.__module__}-{request_id}"
+        tracing = not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start(PROFILE_TRACE_FRAMES)
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            return profiler.runcall(handler, event, context)
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            try:
+                try:
+                    _, peak = tracemalloc.get_traced_memory()
+                    snapshot = tracemalloc.take_snapshot()
+                finally:
+                    if tracing:
+                        tracemalloc.stop()
+                print(f"[profile] {name} {elapsed_ms:.1f} ms, peak traced memory {peak / 1024:.1f} KiB")
+                print(f"[profile] top {PROFILE_TOP_N} by cumulative time:\n{stats_summary(profiler)}")
+                print(f"[profile] top {PROFILE_TOP_N} allocation sites:\n{allocation_summary(snapshot)}")
+                dumped = dump_stats(profiler, name)
+                if dumped:
+                    print(f"[profile] full stats written to {dumped}")
+            except Exception as e:
+                # Profiling must never change the handler's outcome
+                print(f"[profile] {name} reporting failed: {e}")
+
+    return wrapper
@@ -0,0 +1,167 @@
+"""
+Keep-warm pings for the ingest and Alexa Lambdas.
+
+Handler side: both Lambdas check `is_warmup_event` first and answer a ping by
+running their primers concurrently (one cheap call per AWS client, which
+opens and pools its HTTPS connection, plus any cache pre-loads) and holding
+the container for `hold_ms` so concurrent pings land on distinct containers.
+
+    {"_warmup": true, "hold_ms": 200}
+
+A bare EventBridge scheduled event is treated as a ping too.
+
+Scheduler side: `lambda_handler` (deployed as its own function behind an
+EventBridge rule) or the CLI fans out `concurrency` simultaneous pings per
+target. Use one rule per traffic shape, e.g. a plain rule every 5 minutes
+and a morning rule before the medication peak with a larger input:
+
+    {"targets": {"esp32ScheduledMonitorProxy": 20, "esp32ColorLambda": 5}}
+
+The proxy forwards its ping to the main Lambda, so warming the proxy also
+warms the main Lambda at the same concurrency.
+
+Usage:
+    python lambdaWarmup.py --target esp32ScheduledMonitorProxy=20 --hold-ms 250
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+WARMUP_FLAG = "_warmup"
+MAX_HOLD_MS = 2000
+DEFAULT_HOLD_MS = 200
+DEFAULT_REGION = "us-east-1"
+WARMUP_TARGETS = json.loads(os.environ.get("WARMUP_TARGETS", '{"esp32ScheduledMonitorProxy": 5}'))
+
+
+# ---------- HANDLER SIDE ----------
+def is_warmup_event(event: Any) -> bool:
+    if not isinstance(event, dict):
+        return False
+    if event.get(WARMUP_FLAG):
+        return True
+    return event.get("source") == "aws.events" and event.get("detail-type") == "Scheduled Event"
+
+
+def prime(primers: Dict[str, Callable[[], Any]]) -> Dict[str, Any]:
+    """
+    Run every primer concurrently and report per-primer latency in ms. A
+    primer that fails (AccessDenied, missing resource) has still opened its
+    connection, so errors are reported, not raised.
+    """
+    def run(item):
+        name, primer = item
+        started = time.perf_counter()
+        try:
+            primer()
+            return name, round((time.perf_counter() - started) * 1000, 1)
+        except Exception as e:
+            return name, f"{type(e).__name__} after {(time.perf_counter() - started) * 1000:.1f} ms"
+
+    with ThreadPoolExecutor(max_workers=max(1, len(primers))) as pool:
+        return dict(pool.map(run, primers.items()))
+
+
+def handle_warmup(event: Dict[str, Any], primers: Dict[str, Callable[[], Any]]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    primed = prime(primers)
+    hold_ms = min(int(event.get("hold_ms", 0) or 0), MAX_HOLD_MS)
+    remaining = hold_ms / 1000 - (time.perf_counter() - started)
+    if remaining > 0:
+        time.sleep(remaining)
+    result = {
+        "statusCode": 200,
+        "warmup": True,
+        "primed": primed,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+    print("[warmup]", json.dumps(result))
+    return result
+
+
+# ---------- SCHEDULER SIDE ----------
+def fan_out(targets: Dict[str, int],
+            hold_ms: int = DEFAULT_HOLD_MS,
+            region: str = DEFAULT_REGION) -> Dict[str, Any]:
+    """Invoke every target `concurrency` times at once and summarize the pings."""
+    import boto3
+    from botocore.config import Config
+
+    total = sum(targets.values())
+    if not total:
+        return {"invocations": 0}
+    lambda_client = boto3.client(
+        "lambda",
+        region_name=region,
+        config=Config(max_pool_connections=total, retries={"max_attempts": 2}),
+    )
+    payload = json.dumps({WARMUP_FLAG: True, "hold_ms": hold_ms})
+
+    def ping(function_name: str) -> Dict[str, Any]:
+        started = time.perf_counter()
+        try:
+            response = lambda_client.invoke(
+                FunctionName=function_name,
+                InvocationType="RequestResponse",
+                Payload=payload,
+            )
+            body = response["Payload"].read()
+            ok = "FunctionError" not in response
+            return {"target": function_name, "ok": ok,
+                    "ms": (time.perf_counter() - started) * 1000,
+                    "result": json.loads(body) if body and ok else None}
+        except Exception as e:
+            return {"target": function_name, "ok": False, "error": str(e),
+                    "ms": (time.perf_counter() - started) * 1000}
+
+    jobs: List[str] = [name for name, n in targets.items() for _ in range(n)]
+    with ThreadPoolExecutor(max_workers=total) as pool:
+        results = list(pool.map(ping, jobs))
+
+    summary: Dict[str, Any] = {"invocations": total, "targets": {}}
+    for name in targets:
+        mine = [r for r in results if r["target"] == name]
+        latencies = sorted(r["ms"] for r in mine)
+        summary["targets"][name] = {
+            "requested": targets[name],
+            "ok": sum(1 for r in mine if r["ok"]),
+            "max_ms": round(latencies[-1], 1) if latencies else None,
+            "errors": sorted({r["error"] for r in mine if "error" in r}),
+        }
+    return summary
+
+
+def lambda_handler(event, context):
+    event = event or {}
+    targets = event.get("targets") or WARMUP_TARGETS
+    hold_ms = int(event.get("hold_ms", DEFAULT_HOLD_MS))
+    summary = fan_out({k: int(v) for k, v in targets.items()}, hold_ms,
+                      os.environ.get("WARMUP_REGION", DEFAULT_REGION))
+    print("[warmup scheduler]", json.dumps(summary))
+    return summary
+
+
+def parse_target(value: str):
+    name, _, count = value.partition("=")
+    return name, int(count or 1)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Send concurrent keep-warm pings to Lambda functions.")
+    ap.add_argument("--target", action="append", type=parse_target, default=[],
+                    help="FUNCTION=CONCURRENCY (repeatable); defaults to WARMUP_TARGETS")
+    ap.add_argument("--hold-ms", type=int, default=DEFAULT_HOLD_MS)
+    ap.add_argument("--region", default=DEFAULT_REGION)
+    args = ap.parse_args(argv)
+
+    targets = dict(args.target) if args.target else {k: int(v) for k, v in WARMUP_TARGETS.items()}
+    summary = fan_out(targets, args.hold_ms, args.region)
+    print(json.dumps(summary, indent=2))
+    return 0 if all(t["ok"] == t["requested"] for t in summary.get("targets", {}).values()) else 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
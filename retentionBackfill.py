@@ -0,0 +1,113 @@
+"""
+One-off TTL backfill for ColorControllerEvents.
+
+with_retention only stamps the TTL attribute on items written after
+RETENTION_DAYS was introduced, so older items (every historical
+scheduled_time_monitor heartbeat among them) would never expire. This
+scans the events table in parallel segments and sets the TTL attribute on
+every item of a retained event type that lacks it, to the same value
+with_retention would have written: `timestamp` + RETENTION_DAYS[type].
+
+Items already past their retention get an expiry in the past; DynamoDB TTL
+then deletes them over the following days and EventsTtlToS3 archives them
+from the stream, so pace large backfills with --rate.
+
+Usage:
+    python retentionBackfill.py --dry-run
+    python retentionBackfill.py --segments 8 --rate 200
+"""
+import argparse
+import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+from bulkSchedulePush import TokenBucket, call_with_backoff
+from esp32ColorLambda import EVENTS_TABLE, RETENTION_DAYS, TTL_ATTRIBUTE, ddb
+
+DEFAULT_SEGMENTS = 4
+DEFAULT_RATE_PER_SEC = 100.0
+
+
+def retained_types() -> Dict[str, int]:
+    return {t: int(days) for t, days in RETENTION_DAYS.items() if days}
+
+
+def backfill_segment(segment: int,
+                     total_segments: int,
+                     bucket: Optional[TokenBucket],
+                     dry_run: bool) -> Dict[str, int]:
+    """Stamp the TTL attribute on every unstamped item of a retained type in one scan segment."""
+    retention = retained_types()
+    stats = {"scanned": 0, "updated": 0, "skipped": 0, "errors": 0}
+    kwargs = {
+        "TableName": EVENTS_TABLE,
+        "Segment": segment,
+        "TotalSegments": total_segments,
+        "ProjectionExpression": "command_id, #ts, event_type",
+        "FilterExpression": "attribute_not_exists(#ttl)",
+        "ExpressionAttributeNames": {"#ts": "timestamp", "#ttl": TTL_ATTRIBUTE},
+    }
+    while True:
+        resp = call_with_backoff(lambda: ddb.scan(**kwargs))
+        stats["scanned"] += resp.get("ScannedCount", 0)
+        for item in resp.get("Items", []):
+            days = retention.get(item.get("event_type", {}).get("S"))
+            if not days or "timestamp" not in item:
+                stats["skipped"] += 1
+                continue
+            expires_at = int(item["timestamp"]["N"]) + days * 86400
+            if dry_run:
+                stats["updated"] += 1
+                continue
+            try:
+                call_with_backoff(lambda: ddb.update_item(
+                    TableName=EVENTS_TABLE,
+                    Key={"command_id": item["command_id"], "timestamp": item["timestamp"]},
+                    UpdateExpression="SET #ttl = :exp",
+                    # Never resurrect a deleted item or move an expiry already set
+                    ConditionExpression="attribute_exists(command_id) AND attribute_not_exists(#ttl)",
+                    ExpressionAttributeNames={"#ttl": TTL_ATTRIBUTE},
+                    ExpressionAttributeValues={":exp": {"N": str(expires_at)}},
+                ), bucket)
+                stats["updated"] += 1
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") == "ConditionalCheckFailedException":
+                    stats["skipped"] += 1
+                else:
+                    print(f"[backfill_segment] {segment}: {e}")
+                    stats["errors"] += 1
+        if "LastEvaluatedKey" not in resp:
+            break
+        kwargs["ExclusiveStartKey"] = resp["LastEvaluatedKey"]
+    print(f"[backfill_segment] {segment}/{total_segments} done: {json.dumps(stats)}")
+    return stats
+
+
+def backfill(segments: int = DEFAULT_SEGMENTS,
+             rate: Optional[float] = DEFAULT_RATE_PER_SEC,
+             dry_run: bool = False) -> Dict[str, Any]:
+    bucket = TokenBucket(rate, max(1, int(rate))) if rate else None
+    with ThreadPoolExecutor(max_workers=max(1, segments)) as pool:
+        results: List[Dict[str, int]] = list(pool.map(
+            lambda s: backfill_segment(s, segments, bucket, dry_run), range(segments)
+        ))
+    totals = {k: sum(r[k] for r in results) for k in results[0]} if results else {}
+    return {"table": EVENTS_TABLE, "retention_days": retained_types(), "dry_run": dry_run, **totals}
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    ap = argparse.ArgumentParser(description="Stamp TTL on events written before retention was introduced.")
+    ap.add_argument("--segments", type=int, default=DEFAULT_SEGMENTS, help="parallel scan segments")
+    ap.add_argument("--rate", type=float, default=DEFAULT_RATE_PER_SEC, help="max updates per second")
+    ap.add_argument("--dry-run", action="store_true", help="count the items that would be stamped")
+    args = ap.parse_args(argv)
+
+    summary = backfill(args.segments, args.rate, args.dry_run)
+    print(json.dumps(summary, indent=2))
+    return 0 if not summary.get("errors") else 2
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())